@@ -20,13 +20,14 @@ class Actions:
         self.dry_run = not real
 
     def list_actions(self):
-        for name, cmd in self.s.actions:
+        # no actions is an empty tuple, not a mapping
+        for name, cmd in dict(self.s.actions or {}).items():
             name = click.style(name, bold=True)
             cmd = click.style(f'"{cmd}"', dim=True)
             click.echo(f'{name} - {cmd}')
 
     def run(self, command_name):
-        commands = dict(self.s.actions)
+        commands = dict(self.s.actions or {})
         try:
             cmd = commands[command_name]
         except KeyError:
@@ -0,0 +1,178 @@
+"""Benchmarks for sink internals
+
+Run with:
+  python -m sink.bench config --servers 60
+  python -m sink.bench startup --budget 150
+"""
+import os
+import sys
+import gc
+import time
+import statistics
+import subprocess
+import tempfile
+import tracemalloc
+import click
+
+from sink.config import Dict2obj
+from sink.config import ConfigNode
+
+
+def fake_config(server_count):
+    """Build a config dict that looks like a large agency sink.yaml"""
+    servers = {}
+    for i in range(server_count):
+        servers[f'server{i}'] = {
+            'root': f'/var/www/site{i}',
+            'deploy_root': f'/var/www/deploys{i}',
+            'warn': bool(i % 2),
+            'automatic': False,
+            'exclude': ['node_modules', 'storage/logs', '.env'],
+            'control_panel': {'url': 'https://cp.example.com', 'username': 'u', 'password': 'p'},
+            'hosting': {'name': 'host', 'url': 'https://host.example.com', 'username': 'u'},
+            'ssh': [{'name': f'user{j}', 'username': f'user{j}', 'server': f's{i}.example.com',
+                     'key': None, 'port': 22, 'password': None} for j in range(4)],
+            'mysql': [{'db': f'db{j}', 'username': 'u', 'password': 'p', 'hostname': 'localhost',
+                       'port': 3306} for j in range(3)],
+            'urls': [{'url': f'https://site{i}-{j}.example.com', 'admin_url': None,
+                      'username': None, 'password': None} for j in range(4)],
+            'actions': {'clearcache': 'php craft clear-caches/all', 'ls': 'ls -al'},
+        }
+    return {'project': {'name': 'bench', 'root': '.'}, 'servers': servers}
+
+
+def measure(build, repeat):
+    """Return (seconds per build, bytes retained by one build)"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    kept = build()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(i.size_diff for i in after.compare_to(before, 'filename'))
+    del kept
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        build()
+    elapsed = (time.perf_counter() - start) / repeat
+    return elapsed, size
+
+
+@click.group()
+def bench():
+    """Benchmarks for sink internals."""
+
+
+@bench.command()
+@click.option('--servers', '-s', default=60, help='Number of servers in the fake config.')
+@click.option('--repeat', '-r', default=200, help='Number of builds to time.')
+def config(servers, repeat):
+    """Compare Dict2obj with ConfigNode for a large config.
+
+    Each is timed building the whole config and then looking up one
+    server's first ssh user, which is what most commands do."""
+
+    data = fake_config(servers)
+    name = f'server{servers // 2}'
+
+    def eager():
+        o = Dict2obj(**data)
+        o.servers.__dict__[name].ssh[0]['username']
+        return o
+
+    def lazy():
+        o = ConfigNode(data)
+        o.servers[name].ssh[0].username
+        return o
+
+    click.echo(f'{servers} servers, {repeat} builds')
+    for title, build in (('Dict2obj', eager), ('ConfigNode', lazy)):
+        elapsed, size = measure(build, repeat)
+        click.echo(f'  {title:<12} {elapsed * 1e6:10.1f} us/build {size / 1024:10.1f} KiB')
+
+
+# Modules that only specific commands need, none of them should be
+# imported by `sink --help` or `sink single`.
+HEAVY_MODULES = ['coolname', 'plumbum', 'ssl', 'urllib.request', 'yaml', 'sink.deploy',
+                 'sink.vm', 'sink.check', 'sink.db']
+
+STARTUP_CONFIG = """
+project:
+  name: bench
+  root: .
+servers:
+  bench:
+    root: /tmp
+    default: yes
+    automatic: no
+"""
+
+
+def import_times(args, cwd, env):
+    """Run sink with -X importtime and return (total us, imported module names)"""
+    code = 'import sys; from sink.sink import sink; sink(sys.argv[1:])'
+    cmd = [sys.executable, '-X', 'importtime', '-c', code] + args
+    result = subprocess.run(cmd, cwd=cwd, env=env, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE)
+    total = 0
+    modules = set()
+    for line in result.stderr.decode('utf-8').splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules.add(name.strip())
+        # only top level imports, nested ones are in their parent's cumulative time
+        if not name[1:].startswith(' '):
+            total += int(cumulative)
+    return total, modules
+
+
+@bench.command()
+@click.option('--budget', '-b', default=150, show_default=True,
+              help='Maximum import time in milliseconds.')
+@click.option('--runs', '-r', default=5, show_default=True,
+              help='Number of runs per command, the median is used.')
+def startup(budget, runs):
+    """Fail if a cold `sink --help` or `sink single` imports too much.
+
+    Each command is run in a new interpreter with -X importtime in a
+    throw away project.  The command fails if the median import time
+    is over the budget or if any of the modules only needed by other
+    commands were imported."""
+
+    failed = False
+    with tempfile.TemporaryDirectory() as project:
+        with open(os.path.join(project, 'sink.yaml'), 'w') as f:
+            f.write(STARTUP_CONFIG)
+        with open(os.path.join(project, 'index.html'), 'w') as f:
+            f.write('bench')
+        env = dict(os.environ, XDG_CACHE_HOME=os.path.join(project, '.cache'))
+
+        # prime the compiled config cache, only the process is cold
+        import_times(['single', 'index.html'], project, env)
+
+        commands = {
+            'sink --help': ['--help'],
+            'sink single': ['single', 'index.html'],
+        }
+        for title, args in commands.items():
+            totals = []
+            heavy = set()
+            for _ in range(runs):
+                total, modules = import_times(args, project, env)
+                totals.append(total)
+                heavy |= modules & set(HEAVY_MODULES)
+            median = statistics.median(totals) / 1000
+            ok = median <= budget and not heavy
+            failed = failed or not ok
+            status = click.style('ok' if ok else 'FAIL', fg='green' if ok else 'red', bold=True)
+            click.echo(f'{status} {title:<14} {median:7.1f}ms (budget {budget}ms)')
+            if heavy:
+                click.echo(f'     imported: {", ".join(sorted(heavy))}')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    bench()
@@ -12,6 +12,7 @@ from sink.config import config
 from sink.config import Spinner
 from sink.ui import Color
 from sink.ui import ui
+from sink.ssh import Multiplex
 from pathlib import Path
 
 
@@ -90,13 +91,15 @@ class TestConfig:
                 port = ''
                 if ssh.port:
                     port = f'-p {ssh.port}'
+                # the login, root and db checks share one connection
+                multiplex = Multiplex.options(s)
 
-                if self.run_cmd_on_server(user, url, cmd, good, bad, port, key=key):
+                if self.run_cmd_on_server(user, url, cmd, good, bad, port, key=key, multiplex=multiplex):
                     # root
                     cmd = f'cd "{s.root}"'
                     good = f'root dir exists.'
                     bad = f'root dir does not exist on server: {s.root}.'
-                    self.run_cmd_on_server(user, url, cmd, good, bad, port, key=key)
+                    self.run_cmd_on_server(user, url, cmd, good, bad, port, key=key, multiplex=multiplex)
 
                     dbs = self.config.dbs(s.mysql)
                     for db in dbs:
@@ -106,7 +109,7 @@ class TestConfig:
                         cmd = f'mysql --user={db.username} --password="{db.password}" {host} {db.db} --execute="exit";'
                         good = f'DB({db.db}): mysql username, password and db are good.'
                         bad = f'DB({db.db}): mysql error.'
-                        self.run_cmd_on_server(user, url, cmd, good, bad, port, key=key)
+                        self.run_cmd_on_server(user, url, cmd, good, bad, port, key=key, multiplex=multiplex)
 
             urls = self.config.urls(s.urls)
             for u in urls:
@@ -147,9 +150,11 @@ class TestConfig:
         indent = ' ' * spaces
         click.echo(f'{indent}{msg}')
 
-    def run_cmd_on_server(self, user, url, cmd, good, bad, port, key=''):
+    def run_cmd_on_server(self, user, url, cmd, good, bad, port, key='', multiplex=''):
 
-        cmd = f'''ssh {port} -o BatchMode=yes -o 'StrictHostKeyChecking=yes' -o 'ConnectTimeout {self.timeout}'{key} {user}@{url} '{cmd}' '''
+        if multiplex:
+            multiplex = f' {multiplex}'
+        cmd = f'''ssh {port}{multiplex} -o BatchMode=yes -o 'StrictHostKeyChecking=yes' -o 'ConnectTimeout {self.timeout}'{key} {user}@{url} '{cmd}' '''
         # print(cmd)
         # exit()
         result = self.run_cmd(cmd, good, bad)
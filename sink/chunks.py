@@ -0,0 +1,138 @@
+import re
+import zlib
+import hashlib
+import difflib
+
+
+# A line whose crc32 has these bits clear ends a chunk, so the chunks
+# average 1024 lines and an edit only changes the chunks around it
+# instead of shifting every chunk after it.
+MASK = 0x3ff
+MAX_LINES = 8192
+
+
+def chunk_lines(f, mask, max_lines):
+    """Yield (first line, line count, first byte, size, sha1) for each chunk of a file
+
+    The chunks end on lines picked by their content.  This also runs
+    on the server, see chunks_script(), so it only uses the standard
+    library and no names from this module."""
+
+    line_no, offset, count, size = 1, 0, 0, 0
+    h = hashlib.sha1()
+    for line in f:
+        h.update(line)
+        count += 1
+        size += len(line)
+        if zlib.crc32(line) & mask == 0 or count == max_lines:
+            yield line_no, count, offset, size, h.hexdigest()
+            line_no, offset, count, size = line_no + count, offset + size, 0, 0
+            h = hashlib.sha1()
+    if count:
+        yield line_no, count, offset, size, h.hexdigest()
+
+
+def local_chunks(path):
+    with open(path, 'rb') as f:
+        return list(chunk_lines(f, MASK, MAX_LINES))
+
+
+def chunks_script(path):
+    """A python script that prints the chunks of a file on the server"""
+    import inspect
+    return '\n'.join([
+        'import zlib, hashlib',
+        inspect.getsource(chunk_lines),
+        f'with open({str(path)!r}, "rb") as f:',
+        f'    for chunk in chunk_lines(f, {MASK}, {MAX_LINES}):',
+        '        print(*chunk)',
+    ])
+
+
+def regions_script(path, regions):
+    """A python script that outputs the given (first byte, size) of a file on the server"""
+    return '\n'.join([
+        'import sys',
+        f'with open({str(path)!r}, "rb") as f:',
+        f'    for offset, size in {list(regions)!r}:',
+        '        f.seek(offset)',
+        '        sys.stdout.buffer.write(f.read(size))',
+    ])
+
+
+def parse_chunks(output):
+    chunks = []
+    for line in output.splitlines():
+        *numbers, digest = line.split()
+        chunks.append((*[int(i) for i in numbers], digest))
+    return chunks
+
+
+class Region:
+    """Lines that differ between two files, found by comparing chunks
+
+    a and b are (first line, line count, first byte, size) for each
+    side, the count is 0 for lines that are only on the other side."""
+
+    def __init__(self, a, b):
+        self.a = a
+        self.b = b
+
+
+def _span(chunks, start, end):
+    if start == end:
+        # nothing on this side, placed before the next chunk
+        if start < len(chunks):
+            return chunks[start][0], 0, chunks[start][2], 0
+        line, count, offset, size, digest = chunks[-1] if chunks else (1, 0, 0, 0, '')
+        return line + count, 0, offset + size, 0
+    first, last = chunks[start], chunks[end - 1]
+    return (first[0], last[0] + last[1] - first[0],
+            first[2], last[2] + last[3] - first[2])
+
+
+def differing(a, b):
+    """The Regions where the chunks of a and b differ"""
+    matcher = difflib.SequenceMatcher(None, [i[4] for i in a], [i[4] for i in b],
+                                      autojunk=False)
+    return [Region(_span(a, i1, i2), _span(b, j1, j2))
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != 'equal']
+
+
+def read_regions(path, regions):
+    """The content of the (first byte, size) regions of a local file"""
+    with open(path, 'rb') as f:
+        content = []
+        for offset, size in regions:
+            f.seek(offset)
+            content.append(f.read(size))
+        return content
+
+
+def split_regions(content, sizes):
+    """Split what regions_script() output back into the regions"""
+    parts = []
+    offset = 0
+    for size in sizes:
+        parts.append(content[offset:offset + size])
+        offset += size
+    return parts
+
+
+HUNK = re.compile(r'^@@ -(\d+)(,\d+)? \+(\d+)(,\d+)? @@')
+
+
+def unified(region, a_content, b_content):
+    """The hunks of a unified diff of a region, with the files' line numbers"""
+    a_lines = a_content.decode('utf-8', errors='replace').splitlines()
+    b_lines = b_content.decode('utf-8', errors='replace').splitlines()
+    lines = []
+    # the first two lines are the --- +++ file names
+    for line in list(difflib.unified_diff(a_lines, b_lines, lineterm=''))[2:]:
+        hunk = HUNK.match(line)
+        if hunk:
+            a_line = int(hunk.group(1)) + region.a[0] - 1
+            b_line = int(hunk.group(3)) + region.b[0] - 1
+            line = f'@@ -{a_line}{hunk.group(2) or ""} +{b_line}{hunk.group(4) or ""} @@'
+        lines.append(line)
+    return lines
@@ -3,19 +3,72 @@ import sys
 import time
 import threading
 import click
-from pprint import pprint as pp
-import yaml
-import csv
 from pathlib import Path
 from collections import namedtuple
+from collections.abc import Mapping
 from enum import Enum
 import random
-import traceback
+import hashlib
+import fnmatch
+import pickle
+import re
 
 from sink.ui import ui
 from sink.ui import Color
 # from sink.command import Command
-from sink.init import Init
+
+
+class ExcludeMatcher:
+    """rsync style exclude patterns compiled for matching many paths
+
+    A pattern without a slash matches any part of the path, one with
+    a slash matches the end of the path or, if it starts with a slash,
+    the path from the project root or a dir at the start of it.  Plain
+    names are looked up in a set and the wildcard patterns of each
+    kind are joined into one regex, so the cost per path barely grows
+    with the pattern count."""
+
+    def __init__(self, patterns):
+        names = set()
+        wild_names = []
+        anchored = []
+        nested = {}
+        for pattern in patterns:
+            pattern = pattern.rstrip('/')
+            if not pattern:
+                continue
+            if pattern.startswith('/'):
+                anchored.append(fnmatch.translate(pattern[1:]))
+            elif '/' in pattern:
+                depth = pattern.count('/') + 1
+                nested.setdefault(depth, []).append(fnmatch.translate(pattern))
+            elif any(c in pattern for c in '*?['):
+                wild_names.append(fnmatch.translate(pattern))
+            else:
+                names.add(pattern)
+        self.names = frozenset(names)
+        self.wild_names = self._compile(wild_names)
+        self.anchored = self._compile(anchored)
+        self.nested = {depth: self._compile(i) for depth, i in nested.items()}
+
+    @staticmethod
+    def _compile(regexes):
+        return re.compile('|'.join(regexes)).match if regexes else None
+
+    def __call__(self, relpath):
+        parts = relpath.split('/')
+        if not self.names.isdisjoint(parts):
+            return True
+        if self.wild_names and any(self.wild_names(part) for part in parts):
+            return True
+        if self.anchored and any(self.anchored('/'.join(parts[:i]))
+                                 for i in range(1, len(parts) + 1)):
+            return True
+        for depth, match in self.nested.items():
+            for i in range(len(parts) - depth + 1):
+                if match('/'.join(parts[i:i + depth])):
+                    return True
+        return False
 
 
 class Action(Enum):
@@ -87,7 +140,7 @@ class Dict2obj:
         self.raw = level
         for k, v in level.items():
             if isinstance(v, dict):
-                self.__dict__[k] = Dict2obj(**v)
+                self.__dict__[k] = type(self)(**v)
             else:
                 self.__dict__[k] = v
 
@@ -116,6 +169,83 @@ class Dict2obj:
         # return self.raw
 
 
+class ConfigNode(Mapping):
+    """A read only, lazily converted view of a config dict
+
+    Unlike Dict2obj, nested dicts and lists are only wrapped when they
+    are accessed, and the wrapped child is kept for the next access.
+    A server with dozens of ssh/mysql/url entries costs one small
+    object until those entries are actually used.
+
+    node = ConfigNode({'cow': {'color': {'bg': 'black'}}})
+    print(node.cow.color.bg)  # black
+    print(node['cow']['color']['bg'])  # black
+    """
+    __slots__ = ('_data', '_children')
+
+    def __init__(self, data=None, **level):
+        object.__setattr__(self, '_data', level if data is None else data)
+        object.__setattr__(self, '_children', None)
+
+    @classmethod
+    def _wrap(cls, value):
+        if isinstance(value, dict):
+            return cls(value)
+        elif isinstance(value, (list, tuple)):
+            return tuple(cls._wrap(i) for i in value)
+        return value
+
+    def __getitem__(self, key):
+        value = self._data[key]
+        if not isinstance(value, (dict, list, tuple)):
+            return value
+        children = self._children
+        if children is None:
+            children = {}
+            object.__setattr__(self, '_children', children)
+        try:
+            return children[key]
+        except KeyError:
+            child = children[key] = self._wrap(value)
+            return child
+
+    def __getattr__(self, key):
+        # only called when normal attribute lookup fails
+        if key.startswith('_'):
+            raise AttributeError(key)
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(
+                f"'{self.__class__.__name__}' has no attribute '{key}'") from None
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    # compare and hash by identity like Dict2obj, not by content
+    __eq__ = object.__eq__
+    __hash__ = object.__hash__
+
+    def __setattr__(self, key, value):
+        raise AttributeError(f'{self.__class__.__name__} is read only, cannot set "{key}"')
+
+    def __delattr__(self, key):
+        raise AttributeError(f'{self.__class__.__name__} is read only, cannot delete "{key}"')
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({list(self._data)})'
+
+    @property
+    def raw(self):
+        return self._data
+
+    def to_dict(self):
+        return dict(self._data)
+
+
 class Configuration:
     config_file = 'sink.yaml'
     RSYNC = 'rsync'
@@ -129,6 +259,12 @@ class Configuration:
         'rsync_binary': None,
         'note': None,
         'difftool': None,
+        'ssh_persist': None,
+        'endpoint_ttl': None,
+        'profile': None,
+        'media': None,
+        'overrides': None,
+        'ignore_files': None,
         'exclude': [],
     }
     default_server = {
@@ -142,6 +278,12 @@ class Configuration:
         'group': None,
         'user': None,
         'automatic': False,
+        'ssh_persist': None,
+        'endpoint_ttl': None,
+        'profile': None,
+        'media': None,
+        'transport': None,
+        'daemon': None,
         'control_panel': {
             'url': None,
             'usename': None,
@@ -193,9 +335,56 @@ class Configuration:
         'username': None
     }
 
+    default_profile = {
+        # how rsync decides a file has changed: checksum, size or mtime
+        'detect': 'checksum',
+        # rsync's --checksum-choice, eg: xxh128, md5.  None lets rsync pick.
+        'checksum': None,
+        # yes, no, a level from 1 to 9, or an algorithm with an optional
+        # level, eg: zstd, zstd:3
+        'compress': True,
+        # extensions that are sent without compression
+        'skip_compress': [],
+    }
+    # built in profiles, the ones in the profiles section of sink.yaml
+    # are added to these and can replace them
+    profiles = {
+        'default': {},
+        'lan': {'detect': 'mtime', 'compress': False},
+        'media': {'detect': 'mtime', 'compress': True, 'skip_compress': [
+            'jpg', 'jpeg', 'png', 'gif', 'webp', 'avif', 'heic', 'svgz', 'ico',
+            'mp3', 'm4a', 'ogg', 'mp4', 'm4v', 'mov', 'webm', 'avi', 'mkv',
+            'pdf', 'zip', 'gz', 'tgz', 'bz2', 'xz', 'zst', '7z', 'rar',
+            'woff', 'woff2', 'docx', 'xlsx', 'pptx']},
+        # the mirrors keep the servers' times, so the quick check is enough
+        'mirror': {'detect': 'mtime'},
+    }
+    PROFILE_DETECT = ('checksum', 'size', 'mtime')
+    # how files get to a server: over ssh, straight to a path on this
+    # machine (a mounted dir, a lando/ddev app) or to an rsync daemon
+    TRANSPORTS = ('ssh', 'local', 'daemon')
+
+    # bump this when the layout of the cached config changes
+    CACHE_VERSION = 1
+
     def __init__(self, suppress_config_location=True):
         self.suppress = suppress_config_location
         self.suppress_commands = False
+        self._o = None
+        self._reset_resolved()
+
+    def _reset_resolved(self):
+        # project and server objects are resolved once per loaded config
+        self._project = None
+        self._servers = {}
+        self._excludes = {}
+
+    @property
+    def o(self):
+        """The whole config as a ConfigNode, only built when it's asked for"""
+        if self._o is None and self.data:
+            self._o = ConfigNode(self.data)
+        return self._o
 
     def load_config(self, raise_err=False):
         config_exists = self.find_config(os.curdir)
@@ -209,9 +398,149 @@ class Configuration:
                            'any directory above.')
                 sys.exit(1)
 
+        data = self._read_config()
+
+        # take the name of the server and add it to the server data
+        # structure for easier extraction.
+        try:
+            for servername in data['servers']:
+                data['servers'][servername]['servername'] = servername
+        except KeyError:
+            pass  # no servers defined
+        except TypeError:
+            ui.warn('No servers defined in sink.yaml')
+
+        self.data = data
+        self._o = None
+        self._reset_resolved()
+        if not data:
+            ui.error('sink.yaml appears to have no data')
+
+    def cache_home(self):
+        """Sink's user level cache dir, ~/.cache/sink unless XDG_CACHE_HOME is set"""
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+        return Path(base, 'sink')
+
+    def project_cache(self, *parts):
+        """A dir in the project's cache_dir, created if needed
+
+        If cache_dir isn't set in sink.yaml, a dir for the project in
+        the user's cache dir is used instead."""
+
+        cache_dir = self.data['project'].get('cache_dir')
+        if cache_dir:
+            base = Path(self.project_root, os.path.expanduser(cache_dir))
+        else:
+            key = hashlib.sha1(str(self.project_root).encode('utf-8')).hexdigest()
+            base = self.cache_home() / 'projects' / key
+        cache = Path(base, *parts)
+        cache.mkdir(parents=True, exist_ok=True)
+        return cache
+
+    def _config_cache_file(self, kind='config', suffix='.pickle'):
+        config_path = str(Path(self.config_file).absolute())
+        key = hashlib.sha1(config_path.encode('utf-8')).hexdigest()
+        return self.cache_home() / kind / f'{key}{suffix}'
+
+    def completion_index(self):
+        """Return the names used for shell completion
+
+        The server names and each server's action names (plus the
+        project's under 'local') are kept in a small json index that
+        is only rebuilt when sink.yaml changes, so a tab press doesn't
+        parse the config or build any server objects."""
+
+        import json
+        if not self.find_config(os.curdir):
+            return {}
+        stat = os.stat(self.config_file)
+        stamp = [stat.st_mtime_ns, stat.st_size]
+        index_file = self._config_cache_file('completion', '.json')
+        try:
+            with open(index_file) as f:
+                index = json.load(f)
+            if index['stamp'] == stamp:
+                return index
+        except Exception:
+            pass  # missing or broken, rebuild it
+
+        try:
+            self.load_config(raise_err=True)
+        except (FileNotFoundError, SystemExit):
+            return {}
+        servers = self.data.get('servers') or {}
+        actions = {}
+        for name, server in servers.items():
+            actions[name] = list((server or {}).get('actions') or [])
+        project = self.data.get('project') or {}
+        actions['local'] = list(project.get('actions') or [])
+        index = {
+            'stamp': stamp,
+            'servers': list(servers),
+            'actions': actions,
+        }
+        self._write_cache_file(index_file, json.dumps(index).encode('utf-8'))
+        return index
+
+    def _read_config(self):
+        """Return the parsed sink.yaml, using the compiled cache when possible
+
+        The cache is keyed on the mtime and size of sink.yaml, so when
+        nothing has changed loading the config costs a stat and a read
+        of the pickled data.  If the mtime or size changed but the
+        content hash didn't (eg: a git checkout), the stamp is updated
+        without parsing the yaml again."""
+
+        stat = os.stat(self.config_file)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        cache_file = self._config_cache_file()
+
+        cached = None
+        try:
+            with open(cache_file, 'rb') as f:
+                cached = pickle.load(f)
+            if cached['version'] != self.CACHE_VERSION:
+                cached = None
+        except Exception:
+            # a missing or broken cache is never fatal, it gets rebuilt.
+            cached = None
+
+        if cached and cached['stamp'] == stamp:
+            return cached['data']
+
+        with open(self.config_file, 'rb') as f:
+            raw = f.read()
+        digest = hashlib.blake2b(raw, digest_size=16).hexdigest()
+        if cached and cached['digest'] == digest:
+            data = cached['data']
+        else:
+            data = self._parse_config(raw)
+
+        cached = {
+            'version': self.CACHE_VERSION,
+            'stamp': stamp,
+            'digest': digest,
+            'data': data,
+        }
         try:
-            with open(self.config_file) as f:
-                data = yaml.safe_load(f)
+            self._write_cache_file(
+                cache_file, pickle.dumps(cached, protocol=pickle.HIGHEST_PROTOCOL))
+        except pickle.PicklingError:
+            pass
+        return data
+
+    def _parse_config(self, raw):
+        # yaml is only needed when the compiled cache is stale, so it's
+        # not imported at startup.
+        import yaml
+        try:
+            # libyaml is several times faster than the pure python loader
+            from yaml import CSafeLoader as SafeLoader
+        except ImportError:
+            from yaml import SafeLoader
+
+        try:
+            data = yaml.load(raw, Loader=SafeLoader)
         except yaml.YAMLError as e:
             if hasattr(e, 'problem_mark'):
                 msg = 'There was an error while parsing the config file'
@@ -222,55 +551,56 @@ class Configuration:
             else:
                 print("Something went wrong while parsing the yaml file.")
             exit()
+        return data
 
-        # take the name of the server and add it to the server data
-        # structure for easier extraction.
+    def _write_cache_file(self, cache_file, content):
+        """Atomically write a cache file, failures are ignored"""
+        import tempfile
         try:
-            for servername in data['servers']:
-                data['servers'][servername]['servername'] = servername
-        except KeyError:
-            ui.warn(f'Server not found: {servername}')
-            # pass  # no servers defined
-        except TypeError:
-            ui.warn('No servers defined in sink.yaml')
-
-        self.data = data
-        if data:
-            self.o = Dict2obj(**data)
-        else:
-            ui.error('sink.yaml appears to have no data')
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=cache_file.parent, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.replace(tmp, cache_file)
+        except OSError:
+            pass
 
     def find_config(self, cur):
         """Walk up the dir tree to find a config file"""
-        if cur == '/':
-            return False
-        elif str(self.config_file) in os.listdir(cur):
-            self.config_file = Path(cur, self.config_file)
-            self.project_root = Path(cur)
+        config_name = Path(self.config_file).name
+        if os.path.isfile(os.path.join(cur, config_name)):
+            self.config_file = Path(os.path.abspath(cur), config_name)
+            self.project_root = Path(os.path.abspath(cur))
             return True
+        elif os.path.abspath(cur) == '/':
+            return False
         else:
             cur = os.path.abspath(os.path.join(cur, '..'))
             return self.find_config(cur)
 
     def project(self):
-        """Return the project info as a namedtupple
+        """Return the project info as a read only object
+
+        The paths are converted to pathlib paths and checked the first
+        time this is called, after that the same object is returned."""
 
-        Convert the project dict to a namedtuple and convert the paths
-        to pathlib paths."""
+        if self._project is None:
+            self._project = self._resolve_project()
+        return self._project
 
+    def _resolve_project(self):
         project = None
         try:
             project = self.data['project']
         except KeyError:
             ui.error(f'project section in {self.config_file} does not exist')
 
-        p = self.default_project
+        p = self.default_project.copy()
         p.update(project)
 
         # root is required
         try:
-            p['root'] = os.path.expanduser(p['root'])
-            root_d = Path(self.project_root, p['root'])
+            root_d = Path(self.project_root, os.path.expanduser(p['root']))
             root_d = root_d.expanduser().absolute()
             if not root_d.exists():
                 ui.error(f'Root dir does not exist: {root_d}')
@@ -285,11 +615,8 @@ class Configuration:
         if pulls_dir:
             pulls_dir = Path(self.project_root, pulls_dir)
             pulls_dir = pulls_dir.expanduser().absolute().resolve()
-            # pulls_dir = pulls_dir
             if not pulls_dir.exists():
                 ui.error(f'DB pull dir does not exist: {pulls_dir}')
-        # else:
-        #     ui.warn('pulls dir not set')
         p['pulls_dir'] = pulls_dir
 
         # rsync binary
@@ -301,8 +628,7 @@ class Configuration:
             rsync_bin = self.RSYNC
         p['rsync_binary'] = rsync_bin
 
-        p = Dict2obj(**p)
-        return p
+        return ConfigNode(p)
 
     def get_rsync_name(self, rsync_bin: str) -> str:
         if not rsync_bin:
@@ -336,6 +662,9 @@ class Configuration:
             elif not name:
                 ui.error('No server was specified and no server is set to default.')
 
+        if name in self._servers:
+            return self._servers[name]
+
         server = None
         try:
             server = self.data['servers'][name]
@@ -343,18 +672,26 @@ class Configuration:
             click.echo('\nExisting servers:')
             options = {}
             for server in self.servers():
+                ssh = server.ssh[0] if server.ssh else None
                 options[server.name] = '{}@{}'.format(
-                    server.ssh.username,
-                    server.ssh.server
+                    ssh.username if ssh else '',
+                    ssh.server if ssh else '',
                 )
             ui.display_options(options)
             ui.error(f'Server: "{name}" does not exist in {self.config_file}')
 
-        server_data = self._server(server, name)
-        return server_data
+        return self._server(server, name)
 
     def _server(self, server, name):
-        """Convert a server dict to obj"""
+        """Convert a server dict to a read only obj
+
+        The server dict in self.data is left untouched and the result
+        is kept so the ssh keys are only looked up once."""
+
+        if name in self._servers:
+            return self._servers[name]
+
+        server = dict(server)
         for k, v in server.items():
             if k == 'hosting':
                 hosting = self.default_server['hosting'].copy()
@@ -369,7 +706,7 @@ class Configuration:
                 for mysql_db in v:
                     mysql_template = self.default_mysql.copy()
                     mysql_template.update(mysql_db)
-                    mysql_holder.append(Dict2obj(**mysql_template))
+                    mysql_holder.append(mysql_template)
                 server['mysql'] = mysql_holder
             elif k == 'ssh':
                 ssh_holder = []
@@ -383,7 +720,7 @@ class Configuration:
                     ssh_key = None
                     try:
                         ssh_key = ssh_user['key']
-                    except TypeError:
+                    except (TypeError, KeyError):
                         pass
                     if ssh_key:
                         abs_ssh_key = os.path.abspath(os.path.expanduser(ssh_key))
@@ -397,7 +734,7 @@ class Configuration:
                         else:
                             ui.warn(f'ssh key does not exist: {ssh_key}')
 
-                    ssh_holder.append(Dict2obj(**ssh_template))
+                    ssh_holder.append(ssh_template)
 
                 server['ssh'] = ssh_holder
 
@@ -406,9 +743,52 @@ class Configuration:
 
         s = self.default_server.copy()
         s.update(server)
-        server_obj = Dict2obj(**s)
+        server_obj = ConfigNode(s)
+        self._servers[name] = server_obj
         return server_obj
 
+    def profile(self, name=None, server=None):
+        """Return a transfer profile as a read only object
+
+        If no name is given the server's profile is used, then the
+        project's, then the one called default."""
+
+        if not name and server:
+            name = self.server(server).profile
+        if not name:
+            name = self.project().profile or 'default'
+
+        profiles = {k: dict(v) for k, v in self.profiles.items()}
+        try:
+            for k, v in (self.data['profiles'] or {}).items():
+                profiles.setdefault(k, {}).update(v or {})
+        except KeyError:
+            pass
+        except AttributeError:
+            ui.error(f'profiles in {self.config_file} must be profile names with their settings')
+
+        if name not in profiles:
+            click.echo('\nExisting profiles:')
+            ui.display_options({k: profiles[k].get('detect', 'checksum') for k in sorted(profiles)})
+            ui.error(f'Transfer profile: "{name}" does not exist')
+
+        p = self.default_profile.copy()
+        p.update(profiles[name])
+        p['name'] = name
+        if p['detect'] not in self.PROFILE_DETECT:
+            ui.error(f'Profile {name}: detect must be one of {", ".join(self.PROFILE_DETECT)}')
+        return ConfigNode(p)
+
+    def transport(self, server):
+        """How files are sent to a server, one of TRANSPORTS"""
+        s = self.server(server)
+        transport = s.transport or 'ssh'
+        if transport not in self.TRANSPORTS:
+            ui.error(f'{s.servername}: transport must be one of {", ".join(self.TRANSPORTS)}')
+        if transport == 'daemon' and not str(s.daemon or '').startswith('rsync://'):
+            ui.error(f'{s.servername}: the daemon transport needs daemon: rsync://host/module')
+        return transport
+
     def servers(self):
         all_servers = []
         try:
@@ -427,7 +807,7 @@ class Configuration:
         for database in dbs:
             db = self.default_mysql.copy()
             db.update(database)
-            all_dbs.append(Dict2obj(**db))
+            all_dbs.append(ConfigNode(db))
         return all_dbs
 
     def urls(self, urls):
@@ -437,7 +817,7 @@ class Configuration:
             for url in urls:
                 u = self.default_url.copy()
                 u.update(url)
-                all_urls.append(Dict2obj(**u))
+                all_urls.append(ConfigNode(u))
         except AttributeError:
             return False
         return all_urls
@@ -449,7 +829,7 @@ class Configuration:
             for ssh in sshs:
                 s = self.default_ssh.copy()
                 s.update(ssh)
-                all_sshs.append(Dict2obj(**s))
+                all_sshs.append(ConfigNode(s))
         except AttributeError:
             return False
         return all_sshs
@@ -459,7 +839,43 @@ class Configuration:
             **self.data['sync points'])
         return s
 
-    def excluded(self, server):
+    def media_paths(self, server):
+        """The dirs with uploads etc. for `sink media`, relative to the root
+
+        A server's media setting replaces the project's."""
+        paths = self.server(server).media or self.project().media or []
+        if isinstance(paths, str):
+            paths = [paths]
+        return [str(i).strip('/') for i in paths if i]
+
+    # files that can have a per server version, eg: .env.prod
+    default_overrides = ['.env', 'robots.txt', '.htaccess']
+
+    def override_patterns(self):
+        """Names, or fnmatch patterns, of the files with per server versions"""
+        try:
+            patterns = self.data['project']['overrides']
+        except KeyError:
+            patterns = None
+        patterns = [i for i in patterns if i] if patterns else []
+        return patterns or list(self.default_overrides)
+
+    def included(self, server):
+        patterns = self.override_patterns()
+        return ' '.join([f'--include="{i}.{server}"' for i in patterns])
+
+    def exclude_patterns(self, server=None, media=False):
+        """The project's exclude patterns plus the server's, if given
+
+        The patterns in the project's ignore_files, eg: .gitignore,
+        are added as well.  With media, the patterns that exclude one
+        of the server's media dirs, or a dir above it, are left out so
+        `sink media` sends them even though `sink file` skips them."""
+
+        key = ('patterns', server, media)
+        if key in self._excludes:
+            return self._excludes[key]
+
         project_ex = []
         try:
             project_ex = self.data['project']['exclude']
@@ -471,16 +887,81 @@ class Configuration:
         try:
             server_ex = self.data['servers'][server]['exclude']
             server_ex = [i for i in server_ex if i] if server_ex else []
-        except KeyError:
+        except (KeyError, TypeError):
             pass
 
-        all = project_ex + server_ex
+        all = project_ex + server_ex + self._ignore_file_patterns()
         all = set(all)
         all = sorted(all)
-        all = ' '.join([f'--exclude="{i}"' for i in all])
-        # all = ','.join([f"'{i}'" for i in all])
-        # all = f'--exclude={{{all}}}'
+        if media:
+            dirs = []
+            for path in self.media_paths(server):
+                parts = path.split('/')
+                dirs += ['/'.join(parts[:i]) for i in range(1, len(parts) + 1)]
+            all = [i for i in all if not any(ExcludeMatcher([i])(d) for d in dirs)]
+        self._excludes[key] = all
         return all
 
+    def _ignore_file_patterns(self):
+        """Read the patterns from the files listed in the project's ignore_files
+
+        Only patterns that mean the same to rsync are used, negated
+        ones (!pattern) are skipped."""
+
+        try:
+            files = self.data['project']['ignore_files'] or []
+        except KeyError:
+            files = []
+        patterns = []
+        for name in files:
+            path = Path(self.project_root, name)
+            try:
+                with open(path) as f:
+                    lines = f.read().splitlines()
+            except OSError:
+                ui.warn(f'Ignore file does not exist: {path}')
+                continue
+            for line in lines:
+                line = line.strip()
+                if not line or line.startswith('#') or line.startswith('!'):
+                    continue
+                if line.startswith('\\'):
+                    line = line[1:]
+                patterns.append(line)
+        return patterns
+
+    def exclude_matcher(self, server=None, media=False):
+        """An ExcludeMatcher for the server's exclude patterns"""
+        key = ('matcher', server, media)
+        if key not in self._excludes:
+            self._excludes[key] = ExcludeMatcher(self.exclude_patterns(server, media))
+        return self._excludes[key]
+
+    def exclude_file(self, server=None, media=False):
+        """Write the exclude patterns to a file for rsync's --exclude-from
+
+        The file is only rewritten when the patterns change."""
+
+        key = ('file', server, media)
+        if key in self._excludes:
+            return self._excludes[key]
+        content = ''.join([f'{i}\n' for i in self.exclude_patterns(server, media)])
+        name = f'{server or "project"}.media' if media else f'{server or "project"}'
+        path = self.project_cache('excludes') / f'{name}.txt'
+        try:
+            with open(path) as f:
+                current = f.read()
+        except OSError:
+            current = None
+        if current != content:
+            self._write_cache_file(path, content.encode('utf-8'))
+        self._excludes[key] = path
+        return path
+
+    def excluded(self, server, media=False):
+        if not self.exclude_patterns(server, media):
+            return ''
+        return f'--exclude-from="{self.exclude_file(server, media)}"'
+
 
 config = Configuration()
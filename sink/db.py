@@ -14,6 +14,8 @@ from sink.config import config
 from sink.config import Dict2obj
 from sink.ui import Color
 from sink.ui import ui
+from sink.ssh import Multiplex
+from sink.ssh import Endpoints
 
 
 @contextmanager
@@ -79,7 +81,7 @@ class DB:
         if p.pulls_dir is None or not p.pulls_dir.exists():
             ui.error(f'Pulls dir not found: {p.pulls_dir}')
 
-        ssh = s.ssh[0]
+        ssh = Endpoints.best(s)
         if ssh.key:
             identity = f'-i "{ssh.key}"'
             # click.echo(f'Using identity: "{ssh.key}"')
@@ -110,9 +112,10 @@ class DB:
         port = ''
         if ssh.port:
             port = f'-p {ssh.port}'
+        mux = Multiplex.options(s)
 
         cmd = [
-            f'''ssh {port} -C -T {identity} {ssh.username}@{ssh.server}''',
+            f'''ssh {port} -C -T {identity} {mux} {ssh.username}@{ssh.server}''',
             f'''export MYSQL_PWD="{db.password}"; {mysqldump} {self.dryrun} {hostname} {skip_secure} --user={db.username} --single-transaction --triggers --events --routines --no-tablespaces {db.db}''',
             f'''| gzip -c > "{sqlfile}"'''
         ]
@@ -194,17 +197,18 @@ class DB:
         s = self.config.server(server)
         db = s.mysql[0]
 
-        ssh = s.ssh[0]
+        ssh = Endpoints.best(s)
         if ssh.key:
             identity = f'-i "{ssh.key}"'
         else:
             identity = ''
+        mux = Multiplex.options(s)
 
         if local:
             if not sqlfile.exists():
                 ui.error(f'{sqlfile} does not exist')
         else:
-            cmd = f'''ssh -C -T {identity} {ssh.username}@{ssh.server} "test -f {sqlfile}"'''
+            cmd = f'''ssh -C -T {identity} {mux} {ssh.username}@{ssh.server} "test -f {sqlfile}"'''
             result = subprocess.run(cmd, shell=True, stderr=subprocess.PIPE)
             ui.display_cmd(cmd, suppress_commands=config.suppress_commands)
             if result.returncode:
@@ -240,12 +244,12 @@ class DB:
             cmd = [
                 f'''pv --numeric {sqlfile}''',
                 # f'''cat {sqlfile}''',
-                f'''| ssh {port} {identity} {ssh.username}@{ssh.server}''',
+                f'''| ssh {port} {identity} {mux} {ssh.username}@{ssh.server}''',
                 f'''export MYSQL_PWD="{db.password}"; gunzip -c | {mysql} {skip_secure} --user={db.username} {db.db}''',
             ]
             cmd = f"""{cmd[0]} {cmd[1]} '{cmd[2]}'"""
         else:
-            cmd = f'''ssh {port} -T {identity} {ssh.username}@{ssh.server}
+            cmd = f'''ssh {port} -T {identity} {mux} {ssh.username}@{ssh.server}
                       "export MYSQL_PWD="{db.password}"; zcat {sqlfile} | mysql --user={db.username} {db.db}"'''
             cmd = ' '.join(cmd.split())
         self.run_put_cmd(cmd)
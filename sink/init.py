@@ -28,6 +28,38 @@ class Init:
             # specify a gui diff tool to use.  Use {{local}} and {{remote}} for the arguments.
             # eg: meld {{local}} {{remote}}
             difftool: meld {{local}} {{remote}}
+            # how long a shared ssh connection stays open after the last
+            # command (ssh's ControlPersist, eg: 10m, 1h).  Set to 'no' to
+            # open a new connection for every command.  Can also be set
+            # per server.
+            ssh_persist: 10m
+            # how long to remember which of a server's ssh addresses is
+            # the fastest before checking again, eg: 30s, 10m, 1h.  Set to
+            # 'no' to always use the first one.  Can also be set per server.
+            endpoint_ttl: 10m
+            # transfer profile used when a server doesn't set one.  The
+            # built in profiles are default, lan and media, see profiles
+            # below.
+            profile: default
+            # files that can have a different version for each server,
+            # eg: .env.prod is sent to prod and a local deploy links .env
+            # to it.  Patterns like '*.php' work, '*' takes every file
+            # ending with a server name.
+            overrides:
+              - .env
+              - robots.txt
+              - .htaccess
+            # patterns from these files, relative to the project root, are
+            # added to the excludes.  Negated patterns (!name) are skipped.
+            ignore_files:
+              # - .gitignore
+              # - .rsyncignore
+            # dirs of user uploads and other large binary files, relative
+            # to the root.  These are synced with 'sink media' and can be
+            # set per server as well.
+            media:
+              # - web/uploads
+              # - storage/app
             # these files will be excluded from any dir syncing:
             exclude:
               - .git
@@ -46,6 +78,26 @@ class Init:
               - __pycache__
               - .env
 
+          # How rsync finds changed files and compresses them.  A server
+          # picks one with 'profile:' and 'sink file --profile' overrides
+          # it.  These add to or replace the built in profiles.
+          profiles:
+            # checksum every file and compress everything
+            default:
+              detect: checksum  # checksum, size or mtime
+              checksum:         # eg: xxh128, md5, rsync picks if empty
+              compress: yes     # yes, no, 1-9, zstd or zstd:3
+              skip_compress: [jpg, png, gif, webp, mp4, zip, gz]
+            # a Vagrant box or a server on the local network
+            lan:
+              detect: mtime
+              compress: no
+            # image and video uploads, used by 'sink media'
+            media:
+              detect: mtime
+              compress: yes
+              skip_compress: [jpg, jpeg, png, gif, webp, mp4, mov, pdf, zip]
+
           servers:'''
         if not self.server_names:
             self.server_names = ['example_server']
@@ -63,6 +115,17 @@ class Init:
               # will be included in the list of servers that
               # the automatic command sends a single file to.
               automatic: no
+              # transfer profile from the profiles section, defaults to
+              # the project's profile.
+              profile:
+              # How files are sent: ssh (the default), local when root is
+              # a path on this machine (a mounted Vagrant dir, a lando or
+              # ddev app) or daemon for an rsync daemon on the LAN, set
+              # daemon to the module for root, eg: rsync://vagrant.test/site
+              # (RSYNC_PASSWORD is used for its password).  local and
+              # daemon skip ssh and compression.
+              transport:
+              daemon:
               # If you want the group and user to be changed when uploading
               # set group and user to the desired names.  This assumes you have
               # permission to run chown.
@@ -81,8 +144,10 @@ class Init:
                 note: |
               ssh:
                 # Multiple ssh configs can be defined and given a name.  These 
-                # can be specified when sshing into a server, but rsync 
-                # commands will only use the first one.  
+                # can be specified when sshing into a server.  Entries with
+                # the same username as the first one are other addresses
+                # of the server (eg: a VPN address), the fastest one that
+                # answers is used and the others are tried if it fails.
                 - name:
                   username:
                   password:
@@ -0,0 +1,171 @@
+import os
+import json
+import hashlib
+import fnmatch
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+from sink.config import config
+
+
+def file_hash(path):
+    """Hash a file's content, module level so a process pool can use it"""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_sha256(path):
+    """sha256 of a file, to compare with sha256sum on a server"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# below this many files a process pool costs more than it saves
+POOL_THRESHOLD = 64
+
+
+def scan(root, top, excluded):
+    """Return {path: (size, mtime_ns, link target)} for the files below top
+
+    The paths are relative to root.  excluded is an ExcludeMatcher, an
+    excluded dir is skipped without being read."""
+    files = {}
+    dirs = [str(top)]
+    while dirs:
+        with os.scandir(dirs.pop()) as entries:
+            for entry in entries:
+                relpath = os.path.relpath(entry.path, root)
+                if excluded(relpath):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+                    continue
+                stat = entry.stat(follow_symlinks=False)
+                link = os.readlink(entry.path) if entry.is_symlink() else None
+                files[relpath] = (stat.st_size, stat.st_mtime_ns, link)
+    return files
+
+
+def hash_files(root, relpaths):
+    paths = [os.path.join(root, i) for i in relpaths]
+    if len(paths) < POOL_THRESHOLD:
+        return [file_hash(i) for i in paths]
+    with ProcessPoolExecutor() as pool:
+        return list(pool.map(file_hash, paths, chunksize=32))
+
+
+class Manifest:
+    """The local files as they were the last time they were sent to a server
+
+    Kept per server as json in the project's cache dir as
+    {path: (size, mtime_ns, hash)}, with paths relative to the project
+    root.  A file whose size and mtime match its entry isn't read at
+    all.  A file with a new size or mtime is hashed and only counts as
+    changed if its content is different.
+
+    The manifest only knows what sink sent, files changed on the
+    server by other means aren't noticed.  Use `sink file put --full`
+    to have rsync compare everything.
+    """
+    VERSION = 2
+
+    def __init__(self, server_name):
+        self.server_name = server_name
+        self.root = Path(config.project().root)
+        cache = config.project_cache('manifests')
+        self.file = cache / f'{server_name}.json'
+        self.files_from = cache / f'{server_name}.files'
+        self.excluded = config.exclude_matcher(server_name)
+        # the server's override files, rsync includes them before the excludes
+        self.included = [f'{i}.{server_name}' for i in config.override_patterns()]
+        self.entries = self._load()
+
+    def _load(self):
+        """The saved entries or None if there is no usable manifest"""
+        try:
+            with open(self.file) as f:
+                saved = json.load(f)
+            if saved['version'] == self.VERSION:
+                # json has no tuples, the entries come back as lists
+                return {k: tuple(v) for k, v in saved['entries'].items()}
+        except FileNotFoundError:
+            # versions before 2 were pickled, the full sync replaces them
+            try:
+                os.unlink(self.file.with_suffix('.pickle'))
+            except FileNotFoundError:
+                pass
+        except Exception:
+            pass  # missing or broken, the next full sync rebuilds it
+        return None
+
+    def save(self):
+        content = json.dumps({'version': self.VERSION, 'entries': self.entries})
+        config._write_cache_file(self.file, content.encode('utf-8'))
+
+    def _excluded(self, relpath):
+        """Exclude like rsync, an override file is sent even if it matches an exclude"""
+        name = os.path.basename(relpath)
+        if any(fnmatch.fnmatchcase(name, i) for i in self.included):
+            return False
+        return self.excluded(relpath)
+
+    def scan(self, top):
+        return scan(self.root, top, self._excluded)
+
+    def hash_files(self, relpaths):
+        return hash_files(self.root, relpaths)
+
+    def changes(self, top):
+        """Compare the files below top with the manifest
+
+        Returns the changed paths relative to the project root and the
+        new entries for top, to be saved with update() once they have
+        been sent."""
+
+        previous = self.entries or {}
+        current = self.scan(top)
+        entries = {}
+        to_hash = []
+        for relpath, (size, mtime, link) in current.items():
+            old = previous.get(relpath)
+            if old and old[0] == size and old[1] == mtime:
+                entries[relpath] = old
+            elif link is not None:
+                entries[relpath] = (size, mtime, f'link:{link}')
+            else:
+                to_hash.append(relpath)
+        for relpath, digest in zip(to_hash, self.hash_files(to_hash)):
+            size, mtime, link = current[relpath]
+            entries[relpath] = (size, mtime, digest)
+
+        changed = [i for i, entry in entries.items()
+                   if i not in previous or previous[i][2] != entry[2]]
+        return sorted(changed), entries
+
+    def update(self, top, entries):
+        """Replace the entries below top with the ones from changes()"""
+        prefix = os.path.relpath(top, self.root)
+        prefix = '' if prefix == '.' else f'{prefix}/'
+        kept = {k: v for k, v in (self.entries or {}).items() if not k.startswith(prefix)}
+        kept.update(entries)
+        self.entries = kept
+        self.save()
+
+    def relative(self, top, relpaths):
+        """Make paths relative to the project root relative to top"""
+        top = os.path.relpath(top, self.root)
+        return [os.path.relpath(i, top) if top != '.' else i for i in relpaths]
+
+    def write_files_from(self, top, relpaths):
+        """Write the paths, relative to top, to a file for rsync's --files-from"""
+        lines = self.relative(top, relpaths)
+        with open(self.files_from, 'w') as f:
+            f.write(''.join([f'{i}\n' for i in lines]))
+        return self.files_from
+
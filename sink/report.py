@@ -0,0 +1,95 @@
+import re
+
+
+# %i from --itemize-changes, the update type, the file type and 9
+# attribute flags, or a message like *deleting
+ITEM = re.compile(r'^([<>ch.][fdLDS].{9}|\*deleting\s*) (.*)$')
+
+# the --stats lines that are kept and their names in the report
+STATS = {
+    'Number of files': 'files',
+    'Number of regular files transferred': 'transferred',
+    'Total file size': 'total_size',
+    'Total transferred file size': 'transferred_size',
+    'Literal data': 'literal_data',
+    'Matched data': 'matched_data',
+    'Total bytes sent': 'bytes_sent',
+    'Total bytes received': 'bytes_received',
+}
+
+
+def human(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f'{size:.0f}{unit}' if unit == 'B' else f'{size:.1f}{unit}'
+        size /= 1024
+
+
+class Report:
+    """What an rsync run did
+
+    Built from the output of rsync's --itemize-changes and --stats,
+    the output of several rsyncs can be added to one report."""
+
+    def __init__(self, server=None, action=None, real=False):
+        self.server = server
+        self.action = action
+        self.real = real
+        self.created = []
+        self.updated = []
+        self.deleted = []
+        self.stats = {k: 0 for k in STATS.values()}
+        self.seconds = 0.0
+
+    def add(self, lines):
+        """Add rsync's output lines to the report"""
+        for line in lines:
+            item = ITEM.match(line)
+            if item:
+                self._add_item(item.group(1), item.group(2))
+                continue
+            key, _, value = line.partition(': ')
+            if key in STATS:
+                number = value.split(' ', 1)[0].replace(',', '')
+                try:
+                    self.stats[STATS[key]] += int(number)
+                except ValueError:
+                    pass
+        return self
+
+    def _add_item(self, flags, path):
+        if flags.startswith('*deleting'):
+            self.deleted.append(path)
+            return
+        # links are shown as 'path -> target'
+        if flags[1] == 'L':
+            path = path.rsplit(' -> ', 1)[0]
+        if flags[2:] == '+' * 9:
+            self.created.append(path)
+        elif flags[0] in '<>c':
+            self.updated.append(path)
+
+    @property
+    def speedup(self):
+        """rsync's speedup, the total size over the bytes on the wire"""
+        wire = self.stats['bytes_sent'] + self.stats['bytes_received']
+        return round(self.stats['total_size'] / wire, 2) if wire else 0.0
+
+    def to_dict(self):
+        return {
+            'server': self.server,
+            'action': self.action,
+            'dry_run': not self.real,
+            'seconds': round(self.seconds, 3),
+            'created': sorted(self.created),
+            'updated': sorted(self.updated),
+            'deleted': sorted(self.deleted),
+            **self.stats,
+            'speedup': self.speedup,
+        }
+
+    def summary(self):
+        return (f'{len(self.created)} created, {len(self.updated)} updated, '
+                f'{len(self.deleted)} deleted, {human(self.stats["bytes_sent"])} sent '
+                f'({human(self.stats["literal_data"])} literal), '
+                f'speedup {self.speedup:.2f}, {self.seconds:.1f}s')
@@ -1,28 +1,55 @@
 import subprocess
+import sys
 import click
-from pprint import pprint as pp
 from pathlib import Path
 import tempfile
 import os
-import glob
 import re
+import fnmatch
+import io
+import string
+import time
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from sink.config import config
 from sink.ui import Color
 from sink.config import Action
 from sink.ui import ui
+from sink.ssh import Multiplex
+from sink.ssh import Endpoints
+from sink.report import Report
+from sink.report import ITEM
+from sink.report import human
 
 
 # Rsync ignore owner, group, time, and perms:
 # https://unix.stackexchange.com/q/102211
 class Transfer:
+    # most uploads to automatic servers at the same time by `sink single`
+    SINGLE_WORKERS = 8
+    # rsync exit codes worth another try, mostly dropped connections
+    TRANSIENT_CODES = (10, 12, 30, 35)
+    # ssh failing, only tried again on another of the server's endpoints
+    SSH_CODE = 255
+    # vanished source files, the rest of the transfer went fine
+    VANISHED_CODE = 24
+    RETRIES = 3
+    # seconds before the first retry, doubled for each one after
+    RETRY_DELAY = 2
+
     def __init__(
-            self, real, verbose=False, silent=False, quiet=False, server_name=None):
+            self, real, verbose=False, silent=False, quiet=False, server_name=None,
+            profile=None, streams=None, report=None):
         """Transfer files to and from a server with rsync
 
         verbose: adds --verbose to rsync
         silent: adds --quiet to rsync & does not display command output
         quiet: adds --quiet to rsync
+        profile: transfer profile to use instead of the server's
+        streams: number of rsyncs to run at once for a dir, or 'auto'
+        report: 'json' to output the transfer report as json instead
+            of rsync's output and a summary line
         suppress:
         """
         self.verbose = True if verbose else False
@@ -31,25 +58,76 @@ class Transfer:
         # self.config = Config(suppress_config_location=quiet)  # fixme
         self.config = config
         self.prj = config.project()
-        self.server = config.server(server_name)
         # self.ssh = self.server.ssh[0]
         self.server_name = server_name
         self.quiet = quiet
         self.silent = silent
+        self.profile = profile
+        self.streams = streams
+        self.report = report
         self.multiple = False
+        # sending media dirs, their own excludes are dropped, see media()
+        self.media_run = False
+        # the arguments each rsync command was built with, so it can be
+        # built again for another endpoint, see _execute()
+        self._built = {}
+
+    @property
+    def server(self):
+        """The server given to the constructor or the default one
+
+        Looked up when first used so `sink single`, which sends to the
+        automatic servers, doesn't need a default server."""
+        return self.config.server(self.server_name)
 
     def single(self, filename):
-        for server in self.config.servers():
-            locations = self._locations(filename)
-            local = locations['local']
-            remote = locations['remote']
-            if server.automatic:
-                # print(local, remote, server.name, Action.PUT)
-                server.warn = False
-                self._rsync(local, remote, Action.PUT,
-                            single=True, server=remote.name)
-
-    def put(self, filename, extra_flags, dest_override=None):
+        """Upload one file to every automatic server at the same time
+
+        The uploads run in a small thread pool and each server's output
+        is displayed, prefixed with its name, once it finishes, so the
+        total time is about that of the slowest server rather than the
+        sum of all of them."""
+
+        servers = [s for s in self.config.servers() if s.automatic]
+        if not servers:
+            ui.warn('No servers are set to automatic in sink.yaml')
+            return
+
+        jobs = {}
+        workers = min(len(servers), self.SINGLE_WORKERS)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for server in servers:
+                remote = self._locations(filename, server=server)['remote']
+                cmd, s = self._rsync_cmd(filename, remote, Action.PUT, server=server.name)
+                job = pool.submit(self._execute, cmd, False, server)
+                jobs[job] = (cmd, server)
+
+            failed = False
+            for job in as_completed(jobs):
+                cmd, server = jobs[job]
+                returncode, lines, errors = job.result()
+                if not self.silent:
+                    ui.display_cmd(cmd, suppress_commands=config.suppress_commands)
+                    # the threads don't echo, their lines would interleave
+                    for line in lines:
+                        if line.startswith('Number of files:'):
+                            break  # the --stats block
+                        if line:
+                            click.echo(f'[{server.servername}] {line}')
+                if returncode:
+                    failed = True
+                    ui.error(f'[{server.servername}] {self.error_code(returncode)}\n{errors}', exit=False)
+                else:
+                    ui.display_success(self.real, f'[{server.servername}] {filename}')
+        if failed:
+            sys.exit(1)
+
+    def put(self, filename, extra_flags, dest_override=None, manifest=False, full=False):
+        """Upload a file or dir
+
+        With manifest, only the files in a dir that changed since the
+        last put to this server are sent, see sink.manifest.  With full
+        as well, rsync compares everything and the manifest is rebuilt."""
         locations = self._locations(filename)
         local = locations['local']
         # append a / to the remote path if its a dir so rsync will
@@ -60,8 +138,40 @@ class Transfer:
         remote = locations['remote']
         if dest_override:
             remote = dest_override
+        elif manifest and self.multiple:
+            return self._put_changed(locations['local'], local, remote, extra_flags, full)
         self._rsync(local, remote, Action.PUT, extra_flags)
 
+    def _put_changed(self, local_dir, local, remote, extra_flags, full=False):
+        from sink.manifest import Manifest
+
+        manifest = Manifest(self.server.name)
+        changed, entries = manifest.changes(local_dir)
+        everything = full or manifest.entries is None
+        if manifest.entries is None and not full:
+            ui.notice(f'No manifest for {self.server.servername} yet, rsync will compare every file.')
+        elif not everything and not changed:
+            if self.real:
+                manifest.update(local_dir, entries)
+            if self.report == 'json':
+                self._show_report(Report(self.server.name, Action.PUT.value, self.real))
+            else:
+                ui.display_success(self.real, '(nothing has changed since the last put)')
+            return
+
+        if self.streams:
+            send = sorted(entries) if everything else changed
+            sizes = [entries[i][0] for i in send]
+            files = list(zip(manifest.relative(local_dir, send), sizes))
+            sent = self._streams(files, local, remote, Action.PUT, extra_flags)
+        else:
+            if not everything:
+                files_from = manifest.write_files_from(local_dir, changed)
+                extra_flags = f'{extra_flags} --files-from="{files_from}"'
+            sent = self._rsync(local, remote, Action.PUT, extra_flags)
+        if sent and self.real:
+            manifest.update(local_dir, entries)
+
     def pull(self, filename, extra_flags):
         locations = self._locations(filename)
         local = locations['local']
@@ -71,112 +181,654 @@ class Transfer:
         if local.is_dir():
             remote = '{}/'.format(remote)
             self.multiple = True
+            if self.streams:
+                files = self._remote_files(local, remote)
+                return self._streams(files, local, remote, Action.PULL, extra_flags)
         self._rsync(local, remote, Action.PULL, extra_flags)
 
+    def media(self, action, since_last=False):
+        """Put or pull the server's media dirs
+
+        Each dir is sent with parallel streams, see _streams.  The
+        transfer profile and stream count default to media and auto.
+        With since_last only the files changed since the last media
+        sync of that dir in the same direction are sent."""
+
+        from sink.manifest import scan
+
+        s = self.server
+        paths = self.config.media_paths(s.name)
+        if not paths:
+            ui.error(f'No media dirs are set for {s.servername} in sink.yaml')
+        self.multiple = True
+        self.media_run = True
+        self.profile = self.profile or 'media'
+        self.streams = self.streams or 'auto'
+        root = Path(self.prj.root)
+        state_file = self.config.project_cache('media') / f'{s.name}.json'
+        try:
+            with open(state_file) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+        last_syncs = state.setdefault(action.value, {})
+
+        for path in paths:
+            local = root / path
+            remote = Path(s.root, path)
+            since = last_syncs.get(path) if since_last else None
+            click.secho(f'{path}', bold=True, nl=False)
+            click.echo(f' (changed since {time.ctime(since)})' if since else '')
+            started = time.time()
+            if action == Action.PUT:
+                if not local.is_dir():
+                    ui.warn(f'{local} does not exist')
+                    continue
+                excluded = self.config.exclude_matcher(s.name, media=True)
+                files = scan(root, local, excluded).items()
+                files = [(os.path.relpath(i, path), size) for i, (size, mtime, link) in files
+                         if since is None or mtime / 1e9 > since]
+                sent = self._streams(files, f'{local}/', remote, Action.PUT, '')
+            else:
+                if since and not self._has_shell(s):
+                    ui.notice(f'{s.servername} has no ssh entry to find the changed files, '
+                              f'rsync will compare them all')
+                    since = None
+                if since is None:
+                    files = self._remote_files(local, f'{remote}/')
+                else:
+                    files = self._remote_files_since(remote, since)
+                if self.real:
+                    local.mkdir(parents=True, exist_ok=True)
+                sent = self._streams(files, local, f'{remote}/', Action.PULL, '')
+            if sent and self.real:
+                last_syncs[path] = started
+                content = json.dumps(state, indent=2)
+                self.config._write_cache_file(state_file, content.encode('utf-8'))
+
+    def _remote_files_since(self, remote, since):
+        """List the files in a remote dir changed after since as [(path, size)]"""
+        s = self.server
+        find = f"cd '{remote}' && find . -type f -newermt @{int(since)} -printf '%s %P\\n'"
+        cmd, result = self._ssh(s, find)
+        ui.display_cmd(cmd, suppress_commands=config.suppress_commands)
+        if result.returncode:
+            ui.error(f'\n{result.stderr.decode("utf-8")}')
+        excluded = self.config.exclude_matcher(s.name, media=True)
+        # the patterns are matched from the project root
+        top = os.path.relpath(remote, s.root)
+        files = []
+        for line in result.stdout.decode('utf-8').splitlines():
+            size, _, path = line.partition(' ')
+            if path and not excluded(os.path.normpath(os.path.join(top, path))):
+                files.append((path, int(size)))
+        return files
+
+    def _remote_files(self, local, remote):
+        """List the files in a remote dir as [(path, size)]
+
+        Uses rsync's --list-only so the excludes are the same as for
+        the transfer."""
+
+        cmd, s = self._rsync_cmd(local, remote, Action.PULL, extra_flags='--list-only',
+                                 listing=True)
+        result = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode:
+            ui.display_cmd(cmd, suppress_commands=config.suppress_commands)
+            ui.error(f'\n{result.stderr.decode("utf-8")}')
+        files = []
+        for line in result.stdout.decode('utf-8').splitlines():
+            # -rw-r--r--          1,234 2020/01/01 12:00:00 path/to/file
+            parts = line.split(None, 4)
+            if len(parts) < 5 or parts[0][0] not in '-l':
+                continue
+            path = parts[4]
+            if parts[0][0] == 'l':
+                path = path.rsplit(' -> ', 1)[0]
+            files.append((path, int(parts[1].replace(',', ''))))
+        return files
+
+    def _streams(self, files, localf, remotef, action, extra_flags):
+        """Transfer [(path, size)] with several rsyncs running at once
+
+        The files are split into shards of about the same size and
+        number of files, each shard is sent by its own rsync with
+        --files-from over the server's shared ssh connection.  The
+        itemized output of all of them is displayed as one list."""
+
+        from sink.streams import shard, write_shards, StreamTuner
+
+        s = self.server
+        tuner = StreamTuner(s.name)
+        count = tuner.choose() if self.streams == 'auto' else self.streams
+        shards = shard(files, count)
+        if not shards:
+            if self.report == 'json':
+                self._show_report(Report(s.name, action.value, self.real))
+            else:
+                ui.display_success(self.real, '(nothing to transfer)')
+            return True
+        if not self._confirm(action, s, remotef):
+            return False
+
+        if self.config.transport(s.name) == 'ssh':
+            Multiplex.open(s)
+        jobs = []
+        start = time.monotonic()
+        # each run has its own shard lists, another run to the same
+        # server at the same time would overwrite them
+        with tempfile.TemporaryDirectory(prefix=f'sink-{s.name}-') as shard_dir, \
+                ThreadPoolExecutor(max_workers=len(shards)) as pool:
+            for files_from in write_shards(shards, shard_dir):
+                flags = f'{extra_flags} --stats --files-from="{files_from}"'
+                cmd, _ = self._rsync_cmd(localf, remotef, action, extra_flags=flags)
+                jobs.append((cmd, pool.submit(self._execute, cmd, False, s)))
+        seconds = time.monotonic() - start
+
+        failed = False
+        report = Report(s.name, action.value, self.real)
+        report.seconds = seconds
+        items = []
+        for cmd, job in jobs:
+            returncode, lines, errors = job.result()
+            if self._verbose_output():
+                ui.display_cmd(cmd, suppress_commands=config.suppress_commands)
+            report.add(lines)
+            items.extend([i for i in lines if ITEM.match(i)])
+            if returncode:
+                failed = True
+                ui.error(f'{self.error_code(returncode)}\n{errors}', exit=False)
+        if items and self._verbose_output():
+            # itemized lines are 11 flags, a space and the path
+            click.echo('\n'.join(sorted(items, key=lambda i: i[12:])))
+        if failed:
+            sys.exit(1)
+
+        if self.real:
+            tuner.record(len(shards), sum([size for path, size in files]), seconds)
+        self._show_report(report, f'{len(shards)} stream{"s" if len(shards) > 1 else ""}')
+        return True
+
+    # rsync accepts at most 20 --link-dest dirs
+    MAX_LINK_DEST = 20
+    # a build made by `sink deploy new`, server--2020-01-01T00:00:00--fancy-name
+    BUILD_NAME = re.compile(r'^(.+?)--(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)--.+$')
+
     def _hard_link_flag(self, dest, server_name):
-        parent = dest.parent
-        # dirs = os.listdir(parent)
-        # from IPython import embed; embed()
-        dirs = glob.glob(f'{parent.absolute()}/{server_name}*')
-        flag = ''
-        if dirs:
-            last = list(reversed(sorted(dirs)))[0]
-            last = parent / last
-            flag = f'--link-dest={last.absolute()}'
-        return flag
-
-    def _find(self, name, path):
-        for root, dirs, files in os.walk(path):
-            if name in files:
-                return Path(root, name)
-                # return os.path.join(root, name)
+        """--link-dest flags for the most recent builds in the dist dir
+
+        The server's own builds come first, newest first, then the
+        other servers' builds.  rsync only hardlinks a file that is
+        identical in a baseline, so any build can share its files."""
+
+        builds = []
+        try:
+            with os.scandir(dest.parent.absolute()) as entries:
+                for entry in entries:
+                    build = self.BUILD_NAME.match(entry.name)
+                    if not build or not entry.is_dir() or entry.path == str(dest.absolute()):
+                        continue
+                    builds.append((build.group(1), build.group(2), entry.path))
+        except FileNotFoundError:
+            return ''  # the first build
+        builds.sort(key=lambda b: b[1], reverse=True)
+        # sort is stable, so each group stays newest first
+        builds.sort(key=lambda b: b[0] != server_name)
+        dirs = [path for name, created, path in builds[:self.MAX_LINK_DEST]]
+        return ' '.join([f'--link-dest="{i}"' for i in dirs])
+
+    def _link_report(self, dest):
+        """Show how much of a build was copied and how much hardlinked"""
+        copied = [0, 0]
+        linked = [0, 0]
+        dirs = [str(dest)]
+        while dirs:
+            with os.scandir(dirs.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        stat = entry.stat(follow_symlinks=False)
+                        totals = linked if stat.st_nlink > 1 else copied
+                        totals[0] += 1
+                        totals[1] += stat.st_size
+        ui.notice(f'Copied {human(copied[1])} in {copied[0]} files, '
+                  f'hardlinked {human(linked[1])} in {linked[0]} files')
+
+    def _find_overrides(self, path, server_name):
+        """Find every per server file below path in one pass
+
+        A file is an override if its name is one of the project's
+        override patterns followed by .server_name, eg: .env.prod"""
+
+        suffix = f'.{server_name}'
+        patterns = self.config.override_patterns()
+        found = []
+        dirs = [str(path)]
+        while dirs:
+            with os.scandir(dirs.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                    elif entry.name.endswith(suffix):
+                        base = entry.name[:-len(suffix)]
+                        if base and any(fnmatch.fnmatchcase(base, i) for i in patterns):
+                            found.append(Path(entry.path))
+        return sorted(found)
 
     def local(self, server_name, source, dest):
         p = self.config.project()
         server = self.config.server(server_name)
         rsyncb = p.rsync_binary
         excluded = self.config.excluded(server_name)
-
-        included_list = [
-            f'.env.{server.name}',
-            f'robots.txt.{server.name}',
-            f'.htaccess.{server.name}',
-        ]
-        included = ' '.join([f'--include="{i}"' for i in included_list])
+        included = self.config.included(server.name)
 
         hard_link_flag = self._hard_link_flag(dest, server_name)
 
         cmd = f'{rsyncb} --archive --verbose {hard_link_flag} {self.dryrun} {included} {excluded} {source}/ {dest}'
 
         self.run(cmd, single=False, action=Action.PUT, server=server, remotef=dest, localf=source)
+        if not self.dryrun and Path(dest).exists():
+            self._link_report(dest)
 
         # make symlinks to included files or rename them by droping the .server
         if not self.dryrun:
-            for f in included_list:
-                conf_file = self._find(f, dest)
-                if conf_file:
-                    base_name = re.sub(f'\.{server.name}$', '', str(conf_file))
-                    base_name = Path(base_name)
-                    base_name.symlink_to(conf_file.name)
-                    print(f'Symlink created to {conf_file.name} from {base_name}')
-
-
-    def diff_multiple_servers(self, local_file, servers):
-        # for server in servers:
-        #   create a dir
-        #   download file
-        # vimdiff all
-        # remove temp dirs
-        ...
-
-    def diff(self, local_file, ignore=False, word_diff=None, difftool=False):
-        server_name = self.server.name
+            for conf_file in self._find_overrides(dest, server.name):
+                base_name = re.sub(f'\.{server.name}$', '', str(conf_file))
+                base_name = Path(base_name)
+                if base_name.is_symlink():
+                    base_name.unlink()
+                elif base_name.exists():
+                    ui.warn(f'Not replacing {base_name} with a symlink to {conf_file.name}')
+                    continue
+                base_name.symlink_to(conf_file.name)
+                print(f'Symlink created to {conf_file.name} from {base_name}')
+
+
+    def diff_multiple_servers(self, local_file, servers, ignore=False, word_diff=None,
+                              difftool=False):
+        """Compare a file on several servers and the local one at once
+
+        The file is hashed on every server at the same time and the
+        servers are grouped by the hash, eg: [A] local, dev  [B] stag, prod.
+        Only one copy of each variant that is not the same as the local
+        file is downloaded and diffed against it."""
+
+        from sink.manifest import file_sha256
+
         local_file = Path(local_file)
         if local_file.is_dir():
-            self.multiple = True
-            # difftool = True
-        with tempfile.TemporaryDirectory(suffix=f' [{server_name}]') as diffdir:
-            tmp_file = f'{diffdir}/{local_file.name}'
-            locations = self._locations(local_file)
-            remotef = locations['remote']
+            ui.error('Only a single file can be compared on several servers.')
+        servers = [self.config.server(i) for i in servers]
+        local_hash = file_sha256(local_file)
 
-            self._rsync(diffdir, remotef, Action.DIFF, compare_to=local_file)
+        jobs = {}
+        workers = min(len(servers), self.SINGLE_WORKERS)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for server in servers:
+                remote = self._locations(local_file, server=server)['remote']
+                jobs[server.name] = (remote, pool.submit(self._remote_hash, remote, server))
 
-            tmp_file_fixed = tmp_file
-            if self.multiple:
-                tmp_file_fixed = diffdir
+        groups = {local_hash: ['local']}
+        remotes = {}
+        missing = []
+        for server in servers:
+            remote, job = jobs[server.name]
+            cmd, digest, exists = job.result()
+            if cmd:
+                ui.display_cmd(cmd, suppress_commands=config.suppress_commands)
+            if not exists:
+                missing.append(server.name)
+                continue
+            if digest is None:
+                # couldn't be hashed, it is downloaded and diffed on its own
+                if cmd:
+                    ui.warn(f'Could not hash {remote} on {server.servername}, downloading it')
+                digest = f'?{server.name}'
+            groups.setdefault(digest, []).append(server.name)
+            remotes.setdefault(digest, (server.name, remote))
 
-            if difftool:
-                gui = self.prj.difftool
-                if gui:
-                    cmd = gui.format(remote=f'"{tmp_file_fixed}"', local=f'"{local_file}"')
-                else:
-                    ui.error('No difftool program defined in sink.yaml')
-            else:
-                flags = []
-                if ignore:
-                    flags.append('--ignore-all-space')  # --ignore-space-change
-                if word_diff == 'word':
-                    flags.append('--word-diff=color')
-                elif word_diff == 'letter':
-                    flags.append('--word-diff=color --word-diff-regex=.')
-                flags = ' '.join(flags)
+        labels = dict(zip(groups, string.ascii_uppercase))
+        for digest, names in groups.items():
+            click.secho(f'[{labels[digest]}] ', bold=True, nl=False)
+            click.echo(', '.join(names))
+        if missing:
+            click.secho('[-] ', bold=True, nl=False)
+            click.echo(f'{", ".join(missing)} (missing)')
 
-                cmd = f'''git --no-pager diff --color=always {flags} --diff-algorithm=minimal --ignore-all-space\
-                          '{tmp_file_fixed}' '{local_file}' | less'''
+        variants = [i for i in groups if i != local_hash]
+        if not variants:
+            click.echo('Files are the same.')
+            return
 
-            # cmd = f'vimdiff -R {tmp_file_fixed} {local_file}'
-            # cmd = ' '.join(cmd.split())
+        # each variant is brought up to date in the mirror of the first
+        # server that has it
+        self.profile = self.profile or 'mirror'
+        fetched = {}
+        with ThreadPoolExecutor(max_workers=len(variants)) as pool:
+            for digest in variants:
+                server = self.config.server(remotes[digest][0])
+                cmd, mirrored = self._mirror_cmd(local_file, server)
+                job = pool.submit(self._execute, cmd, False, server)
+                fetched[digest] = (cmd, mirrored, job)
 
+        for digest in variants:
+            cmd, mirrored, job = fetched[digest]
+            returncode, lines, errors = job.result()
             ui.display_cmd(cmd, suppress_commands=config.suppress_commands)
-            result = subprocess.run(cmd, shell=True)
-            if not difftool and result.returncode == 0:
+            if returncode:
+                ui.error(f'{self.error_code(returncode)}\n{errors}', exit=False)
+                continue
+            click.secho(f'\n[{labels[digest]}] {", ".join(groups[digest])}', bold=True)
+            cmd = self._diff_cmd(mirrored, local_file, ignore, word_diff, difftool)
+            ui.display_cmd(cmd, suppress_commands=config.suppress_commands)
+            subprocess.run(cmd, shell=True)
+
+    def _ssh(self, server, remote_cmd, input=None):
+        """Run a command on the server, returns the command and the result
+
+        input is sent to the command's stdin.  Exits if ssh itself
+        failed, a failing remote command is left to the caller.  A
+        server with the local transport is on this machine, the command
+        is run here."""
+
+        if self.config.transport(server.name) == 'local':
+            result = subprocess.run(remote_cmd, shell=True, input=input,
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            return remote_cmd, result
+        if not self._has_shell(server):
+            ui.error(f'{server.servername} has no ssh entry in sink.yaml, '
+                     f'sink can only rsync to its daemon')
+
+        ssh = Endpoints.best(server)
+        tried = set()
+        while True:
+            tried.add(Endpoints.key(ssh))
+            port = f'-p {ssh.port}' if ssh.port else ''
+            identity = f'-i "{ssh.key}"' if ssh.key else ''
+            mux = Multiplex.options(server)
+            cmd = f'''ssh {port} -T {identity} {mux} {ssh.username}@{ssh.server} "{remote_cmd}"'''
+            cmd = ' '.join(cmd.split())
+            result = subprocess.run(cmd, shell=True, input=input,
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            endpoint = Endpoints.failover(server, ssh) if result.returncode == self.SSH_CODE else None
+            if not endpoint or Endpoints.key(endpoint) in tried:
+                break
+            ui.warn(f'[{server.servername}] {ssh.server} did not answer, trying {endpoint.server}')
+            ssh = endpoint
+        if result.returncode == self.SSH_CODE:
+            ui.display_cmd(cmd, suppress_commands=config.suppress_commands)
+            ui.error(f'[{server.servername}]\n{result.stderr.decode("utf-8")}')
+        return cmd, result
+
+    def _has_shell(self, server):
+        """If commands can be run on the server, a daemon may have no ssh"""
+        return bool(server.ssh) or self.config.transport(server.name) == 'local'
+
+    # _remote_hash's exit code for a file that isn't on the server
+    MISSING_CODE = 3
+
+    def _remote_hash(self, remotef, server=None):
+        """Return the command, the sha256 of a file on the server and if it exists
+
+        The hash is None if the file doesn't exist or couldn't be
+        hashed, eg: no sha256sum or shasum on the server or no
+        permission to read the file."""
+
+        s = server or self.server
+        if not self._has_shell(s):
+            # a daemon without ssh, only rsync can tell
+            return None, None, True
+        remote_cmd = (f"test -e '{remotef}' || exit {self.MISSING_CODE}; "
+                      f"sha256sum '{remotef}' 2>/dev/null || shasum -a 256 '{remotef}'")
+        cmd, result = self._ssh(s, remote_cmd)
+        if result.returncode == self.MISSING_CODE:
+            return cmd, None, False
+        digest = result.stdout.decode('utf-8').split(' ', 1)[0]
+        if result.returncode or len(digest) != 64:
+            return cmd, None, True
+        return cmd, digest, True
+
+    def diff(self, local_file, ignore=False, word_diff=None, difftool=False, large=False):
+        """Diff a local file or dir with the server's
+
+        A file is hashed on the server first and nothing is downloaded
+        if it's the same.  Otherwise the server's mirror is brought up
+        to date, see mirror(), and the local file is diffed against it.
+        A file over LARGE_DIFF, or any file with large, is compared in
+        chunks instead, see _diff_large()."""
+
+        local_file = Path(local_file)
+        if not local_file.is_dir():
+            from sink.manifest import file_sha256
+            remotef = self._locations(local_file)['remote']
+            cmd, digest, exists = self._remote_hash(remotef)
+            if cmd:
+                ui.display_cmd(cmd, suppress_commands=config.suppress_commands)
+            if not exists:
+                ui.error(f'{remotef} does not exist on {self.server.servername}')
+            if digest is None and cmd:
+                ui.warn(f'Could not hash {remotef} on {self.server.servername}, downloading it')
+            elif digest == file_sha256(local_file):
                 click.echo('Files are the same.')
+                return
+            if large or local_file.stat().st_size >= self.LARGE_DIFF:
+                if not self._has_shell(self.server):
+                    ui.warn(f'{self.server.servername} has no ssh entry to compare chunks, '
+                            f'downloading the whole file')
+                elif self._diff_large(local_file, remotef, fallback=not large):
+                    return
 
-    def _locations(self, filename, ignore=False, difftool=False):
-        p = self.config.project()
-        # s = self.config.server(server)
+        mirrored = self.mirror(local_file)
+        cmd = self._diff_cmd(mirrored, local_file, ignore, word_diff, difftool)
+        ui.display_cmd(cmd, suppress_commands=config.suppress_commands)
+        result = subprocess.run(cmd, shell=True)
+        if not difftool and result.returncode == 0:
+            click.echo('Files are the same.')
+
+    # files this big are diffed in chunks, see _diff_large()
+    LARGE_DIFF = 64 * 1024 * 1024
+    # fetching more than this of a large file is left to `sink mirror`
+    MAX_DIFF_FETCH = 32 * 1024 * 1024
+
+    def _diff_large(self, local_file, remotef, fallback=False):
+        """Diff a large file without downloading it
+
+        Both files are split into chunks of lines, see sink.chunks,
+        and only the chunks that don't match are fetched from the
+        server, with python3 on the server.  Shows the line and byte
+        ranges that differ and a diff of them.  Returns False if the
+        server couldn't split the file and fallback is set, so the
+        whole file is downloaded instead."""
+
+        from sink import chunks
+        s = self.server
+        cmd, result = self._ssh(s, 'python3 -', input=chunks.chunks_script(remotef).encode('utf-8'))
+        ui.display_cmd(cmd, suppress_commands=config.suppress_commands)
+        if result.returncode and fallback:
+            ui.warn(f'Could not split {remotef} into chunks on {s.servername}, '
+                    f'downloading the whole file')
+            return False
+        if result.returncode:
+            ui.error(f'Could not split {remotef} into chunks on {s.servername}, '
+                     f'python3 is needed on the server\n{result.stderr.decode("utf-8")}')
+        remote = chunks.parse_chunks(result.stdout.decode('utf-8'))
+        local = chunks.local_chunks(local_file)
+        regions = chunks.differing(remote, local)
+
+        click.secho(f'{len(regions)} of {max(len(remote), len(local))} chunks differ:', bold=True)
+        for region in regions:
+            click.echo(f'  {s.name} lines {self._line_range(region.a)} '
+                       f'(bytes {region.a[2]}+{region.a[3]}), '
+                       f'local lines {self._line_range(region.b)} '
+                       f'(bytes {region.b[2]}+{region.b[3]})')
+        fetch = sum([i.a[3] for i in regions])
+        if fetch > self.MAX_DIFF_FETCH:
+            click.echo(f'Not fetching {human(fetch)} from {s.servername}, '
+                       f'use `sink mirror {s.name} {local_file}` and diff that.')
+            return True
+
+        spans = [(i.a[2], i.a[3]) for i in regions]
+        cmd, result = self._ssh(s, 'python3 -', input=chunks.regions_script(remotef, spans).encode('utf-8'))
+        ui.display_cmd(cmd, suppress_commands=config.suppress_commands)
+        if result.returncode:
+            ui.error(f'\n{result.stderr.decode("utf-8")}')
+        remote_parts = chunks.split_regions(result.stdout, [i.a[3] for i in regions])
+        local_parts = chunks.read_regions(local_file, [(i.b[2], i.b[3]) for i in regions])
+
+        lines = [f'--- {s.name}:{remotef}', f'+++ {local_file}']
+        for region, a, b in zip(regions, remote_parts, local_parts):
+            lines += chunks.unified(region, a, b)
+        colors = {'+': Color.GREEN.value, '-': Color.RED.value, '@': Color.CYAN.value}
+        click.echo_via_pager('\n'.join([click.style(i, fg=colors.get(i[:1])) for i in lines]) + '\n')
+        click.echo(f'Fetched {human(fetch)} of {human(remote[-1][2] + remote[-1][3] if remote else 0)}.')
+        return True
+
+    @staticmethod
+    def _line_range(span):
+        line, count = span[:2]
+        if not count:
+            return f'none (before {line})'
+        return f'{line}-{line + count - 1}'
+
+    def mirror(self, local_file=None):
+        """Bring the server's copy of a file or dir up to date in its mirror
+
+        Each server has a mirror of the project in the project's cache
+        dir that is kept between runs, so only what changed on the
+        server since the last time is downloaded.  A dir's mirror is
+        seeded from the local files, only the ones that differ are
+        fetched the first time.  It keeps the server's times and
+        rsync's quick check finds the changes without hashing every
+        file.  Returns the path in the mirror."""
+
+        local_file = Path(local_file or self.prj.root).absolute()
+        self.profile = self.profile or 'mirror'
+        cmd, mirrored = self._mirror_cmd(local_file, self.server)
+        remotef = self._locations(local_file)['remote']
+        self.run(cmd, False, Action.PULL, self.server, remotef, mirrored, report=True)
+        return mirrored
+
+    def mirror_path(self, local_file=None, server=None):
+        """Where a local file or dir is in a server's mirror"""
+        local_file = Path(local_file or self.prj.root).absolute()
+        relpath = os.path.relpath(local_file, Path(self.prj.root).absolute())
+        return Path(self.config.project_cache('mirror', (server or self.server).name), relpath)
+
+    def _mirror_cmd(self, local_file, server):
+        """The rsync command that updates a file or dir in the server's mirror"""
+        mirrored = self.mirror_path(local_file, server)
+        remotef = self._locations(local_file, server=server)['remote']
+        if local_file.is_dir():
+            self.multiple = True
+            # the local files are copied into the mirror instead of
+            # downloaded when they match the server's.  They have their
+            # own times, so a new mirror compares them by checksum.
+            flags = f'--delete --stats --copy-dest="{local_file.absolute()}"'
+            if not mirrored.is_dir() or not any(mirrored.iterdir()):
+                flags = f'{flags} --checksum'
+            mirrored.mkdir(parents=True, exist_ok=True)
+            # the excludes protect their files in the mirror from --delete
+            cmd, _ = self._rsync_cmd(f'{mirrored}/', f'{remotef}/', Action.PULL,
+                                     extra_flags=flags, server=server.name)
+        else:
+            mirrored.parent.mkdir(parents=True, exist_ok=True)
+            cmd, _ = self._rsync_cmd(mirrored, remotef, Action.PULL,
+                                     extra_flags='--stats', server=server.name)
+        return cmd, mirrored
+
+    def diff_summary(self, local_file):
+        """List the files that differ without downloading them
+
+        rsync compares the server with the local tree in a dry run and
+        the itemized output is sorted into the files only on the
+        server, the ones only here and the ones that changed, with the
+        change in size."""
+
+        local_file = Path(local_file)
         s = self.server
+        remotef = self._locations(local_file)['remote']
+        flags = '--dry-run --out-format="%i %l %n"'
+        if local_file.is_dir():
+            self.multiple = True
+            remotef = f'{remotef}/'
+            local = f'{local_file}/'
+            # only lists the local files that aren't on the server
+            flags = f'{flags} --delete'
+        else:
+            local = local_file
+
+        cmd, _ = self._rsync_cmd(local, remotef, Action.PULL, extra_flags=flags)
+        ui.display_cmd(cmd, suppress_commands=config.suppress_commands)
+        result = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode:
+            ui.error(f'\n{result.stderr.decode("utf-8")}')
+
+        base = local_file if self.multiple else local_file.parent
+        remote_only, local_only, changed = [], [], []
+        for line in result.stdout.decode('utf-8').splitlines():
+            # eg: >f.st...... 1234 path/to/file
+            flags, _, rest = line.partition(' ')
+            size, _, path = rest.strip().partition(' ')
+            if flags.startswith('*deleting') and not size.isdigit():
+                # some rsyncs don't give a length for deletions
+                size, path = '0', rest.strip()
+            if not path or path.endswith('/') or not size.isdigit():
+                continue
+            try:
+                local_size = os.lstat(base / path).st_size
+            except OSError:
+                local_size = None
+            if flags.startswith('*deleting'):
+                local_only.append((path, -(local_size or 0)))
+            elif flags[2:] == '+' * 9 or local_size is None:
+                remote_only.append((path, int(size)))
+            elif flags[0] in '>c':
+                changed.append((path, int(size) - local_size))
+
+        sections = (
+            (f'Only on {s.servername}', '+', Color.GREEN, remote_only),
+            ('Only local', '-', Color.RED, local_only),
+            ('Changed', '~', Color.YELLOW, changed),
+        )
+        for title, mark, color, files in sections:
+            if not files:
+                continue
+            click.secho(f'{title} ({len(files)}):', bold=True)
+            width = max([len(path) for path, delta in files])
+            for path, delta in sorted(files):
+                sign = '+' if delta > 0 else '-' if delta < 0 else ' '
+                click.echo(click.style(f'  {mark} {path.ljust(width)}', fg=color.value)
+                           + f'  {sign}{human(abs(delta))}')
+        if not (remote_only or local_only or changed):
+            click.echo('Files are the same.')
+        else:
+            click.echo(f'Use `sink diff {s.name} <file>` to see the changes to a file.')
+
+    def _diff_cmd(self, remote_file, local_file, ignore=False, word_diff=None, difftool=False):
+        if difftool:
+            gui = self.prj.difftool
+            if gui:
+                cmd = gui.format(remote=f'"{remote_file}"', local=f'"{local_file}"')
+            else:
+                ui.error('No difftool program defined in sink.yaml')
+        else:
+            flags = []
+            if ignore:
+                flags.append('--ignore-all-space')  # --ignore-space-change
+            if word_diff == 'word':
+                flags.append('--word-diff=color')
+            elif word_diff == 'letter':
+                flags.append('--word-diff=color --word-diff-regex=.')
+            flags = ' '.join(flags)
+
+            cmd = f'''git --no-pager diff --color=always {flags} --diff-algorithm=minimal --ignore-all-space\
+                      '{remote_file}' '{local_file}' | less'''
+        return cmd
+
+    def _locations(self, filename, ignore=False, difftool=False, server=None):
+        p = self.config.project()
+        s = server or self.server
         local = filename
         remote = str(local)
         # remove the local project root from the file
@@ -194,30 +846,32 @@ class Transfer:
 
     def _rsync(self, localf, remotef, action, extra_flags='',
                single=False, compare_to=None, server=None):
+        cmd, s = self._rsync_cmd(localf, remotef, action, extra_flags=f'{extra_flags} --stats',
+                                 compare_to=compare_to, server=server)
+        return self.run(cmd, single, action, s, remotef, localf, report=True)
+
+    def _rsync_cmd(self, localf, remotef, action, extra_flags='',
+                   compare_to=None, server=None, listing=False):
+        """Build the rsync command, returns the command and the server obj
+
+        listing: the command only lists files, it gets no change
+        detection, compression or partial dir flags.  Listing is safe,
+        so it has no --dry-run and is done for real on a dry run."""
 
+        built = ((localf, remotef, action),
+                 dict(extra_flags=extra_flags, compare_to=compare_to, server=server, listing=listing))
         # for single(), the server is not global
         # print('>>>', self.server, server)
-        s = self.server
-        if server:
-            s = self.config.server(server)
-
-        ssh = s.ssh[0]  # use the first ssh server defined
+        s = self.config.server(server) if server else self.server
+        transport = self.config.transport(s.name)
 
-        identity = ''
-        if ssh.key:
-            identity = f'--rsh="ssh -i {ssh.key}"'
 
-        included = [
-            f'.env.{s.name}',
-            f'robots.txt.{s.name}',
-            f'.htaccess.{s.name}',
-        ]
-        included = ' '.join([f'--include="{i}"' for i in included])
+        included = self.config.included(s.name)
 
         excluded = ''
         recursive = ''
         if self.multiple:
-            excluded = self.config.excluded(self.server)
+            excluded = self.config.excluded(s.name, media=self.media_run)
             recursive = '--recursive'
 
         group = ''
@@ -238,64 +892,218 @@ class Transfer:
         if self.verbose:
             verbose_flag = '--verbose'
 
-        port = ''
-        if ssh.port:
-            # https://stackoverflow.com/a/4630407
-            port = f'-e "ssh -p {ssh.port}"'
+        # keep partly sent files so a retry or the next run can resume
+        # them.  The receiver keeps them, so a pull uses the cache and
+        # a put a dir on the server that rsync hides from transfers.
+        partial = ''
+        if listing:
+            pass
+        elif action == Action.PULL:
+            partial = f'--partial-dir="{self.config.project_cache("partial", s.name)}"'
+        elif action == Action.PUT:
+            partial = '--partial-dir=.sink-partial'
+
+        rsh = ''
+        if transport == 'ssh':
+            ssh = Endpoints.best(s)  # the fastest of the server's endpoints
+            # the port, key and multiplexing options all go in one remote
+            # shell command: https://stackoverflow.com/a/4630407
+            rsh = []
+            if ssh.port:
+                rsh.append(f'-p {ssh.port}')
+            if ssh.key:
+                rsh.append(f'-i {ssh.key}')
+            rsh.append(Multiplex.options(s))
+            rsh = ' '.join([i for i in rsh if i])
+            rsh = f'--rsh="ssh {rsh}"' if rsh else ''
+            server_file = f'{ssh.username}@{ssh.server}:{remotef}'
+        elif transport == 'daemon':
+            # the module is the server's root
+            relpath = os.path.relpath(remotef, s.root)
+            server_file = s.daemon.rstrip('/')
+            if relpath != '.':
+                server_file = f'{server_file}/{relpath}'
+            if str(remotef).endswith('/'):
+                server_file = f'{server_file}/'
+        else:
+            server_file = remotef
 
         rsyncb = self.config.project().rsync_binary
+        profile = '' if listing else self._profile_flags(s.name)
+        dryrun = '' if listing else self.dryrun
 
         # --no-perms --no-owner --no-group --no-times --ignore-times
         # flags = ['--verbose', '--compress', '--checksum', '--recursive']
-        cmd = f'''{rsyncb} {self.dryrun} {port} {identity} {group} {extra_flags} {verbose_flag} --itemize-changes
-                  --links --compress --checksum {recursive} {included} {excluded}'''
+        cmd = f'''{rsyncb} {dryrun} {rsh} {group} {extra_flags} {verbose_flag} --itemize-changes
+                  --links {profile} {partial} {recursive} {included} {excluded}'''
 
         if action == Action.PUT:
-            cmd = f'''{cmd} '{localf}' {ssh.username}@{ssh.server}:{remotef}'''
+            cmd = f'''{cmd} '{localf}' '{server_file}' '''
         elif action == Action.PULL:
-            cmd = f'''{cmd} '{ssh.username}@{ssh.server}:{remotef}' '{localf}' '''
+            cmd = f'''{cmd} '{server_file}' '{localf}' '''
         elif action == Action.DIFF:
             if self.multiple:
-                remotef = str(remotef) + '/'
-            cmd = f'''{cmd} --compare-dest='{compare_to}' '{ssh.username}@{ssh.server}:{remotef}' '{localf}' '''
+                server_file = str(server_file) + '/'
+            cmd = f'''{cmd} --compare-dest='{compare_to}' '{server_file}' '{localf}' '''
 
         cmd = ' '.join(cmd.split())  # remove extra spaces
         # print(cmd);exit()
-        self.run(cmd, single, action, s, remotef, localf)
+        self._built[cmd] = built
+        return cmd, s
 
-    def run(self, cmd, single, action, server, remotef, localf):
+    def _profile_flags(self, server):
+        """The change detection and compression flags for a server's profile"""
+        profile = self.config.profile(self.profile, server=server)
+        flags = []
+        # nothing is gained compressing what doesn't go over ssh
+        compress = profile.compress if self.config.transport(server) == 'ssh' else False
+
+        if profile.detect == 'checksum':
+            flags.append('--checksum')
+            if profile.checksum:
+                flags.append(f'--checksum-choice={profile.checksum}')
+        elif profile.detect == 'size':
+            flags.append('--size-only')
+        elif profile.detect == 'mtime':
+            # rsync's own quick check, the times have to be kept for
+            # it to work on the next transfer
+            flags.append('--times')
+
+        if compress is True:
+            flags.append('--compress')
+        elif isinstance(compress, int) and compress is not False:
+            flags.append(f'--compress --compress-level={compress}')
+        elif isinstance(compress, str):
+            choice, _, level = compress.partition(':')
+            flags.append(f'--compress --compress-choice={choice}')
+            if level:
+                flags.append(f'--compress-level={level}')
+        if compress is not False and profile.skip_compress:
+            skip = '/'.join([str(i).lstrip('.') for i in profile.skip_compress])
+            flags.append(f'--skip-compress={skip}')
+
+        return ' '.join(flags)
+
+    def _confirm(self, action, server, remotef):
+        """If the server has warn = True, ask before overwriting its files"""
+        if action == Action.PUT and server.warn and self.real:
+            warn = click.style(
+                ' WARNING: ', bg=Color.YELLOW.value, fg=Color.RED.value,
+                bold=True, dim=True)
+            msg = click.style(
+                f': You are about to overwrite the {server.servername} "{remotef}" files, continue?',
+                fg=Color.YELLOW.value)
+            msg = warn + msg
+            return click.confirm(msg)
+        return True
+
+    def run(self, cmd, single, action, server, remotef, localf, report=False):
+        """Run the rsync command, returns True if it was run and succeeded
+
+        report: the command has --stats, show a summary of what was
+        transferred instead of just success."""
         doit = True
         # if the server has warn = True, then pause here to query the user.
         if not single:
-            if action == Action.PUT and server.warn and self.real:
-                doit = False
-                warn = click.style(
-                    ' WARNING: ', bg=Color.YELLOW.value, fg=Color.RED.value,
-                    bold=True, dim=True)
-                msg = click.style(
-                    f': You are about to overwrite the {server.servername} "{remotef}" files, continue?',
-                    fg=Color.YELLOW.value)
-                msg = warn + msg
-                if click.confirm(msg):
-                    doit = True
+            doit = self._confirm(action, server, remotef)
 
         if doit:
-            result = subprocess.run(cmd, shell=True, stderr=subprocess.PIPE)
-            if result.returncode:
+            start = time.monotonic()
+            returncode, lines, errors = self._execute(cmd, self._verbose_output(), server)
+            if returncode:
                 if not self.silent:
                     ui.display_cmd(cmd, suppress_commands=config.suppress_commands)
-                ui.error(f'\n{result.stderr.decode("utf-8")}')
+                ui.error(f'{self.error_code(returncode)}\n{errors}')
             else:
-                if not self.silent:
+                if self._verbose_output():
                     ui.display_cmd(cmd, suppress_commands=config.suppress_commands)
                 if single:
                     ui.display_success(self.real, f'[{server.servername}] {localf}')
+                elif report:
+                    result = Report(server.name, action.value, self.real).add(lines)
+                    result.seconds = time.monotonic() - start
+                    self._show_report(result)
                 else:
                     ui.display_success(self.real)
+        return doit
+
+    def _execute(self, cmd, echo=True, server=None):
+        """Run rsync, retrying with a backoff if it fails on a dropped connection
+
+        Partly sent files are kept in the partial dir so each retry
+        picks up where the last one stopped.  If ssh fails and the
+        server has an endpoint that hasn't been tried, the retry uses it
+        straight away.  ssh failing on the same endpoint again is likely
+        a refused key or host key, so that isn't retried.  Returns the
+        same as _execute_once, for the last attempt."""
+
+        name = server.servername if server else ''
+        tried = set()
+        for attempt in range(self.RETRIES + 1):
+            returncode, lines, errors = self._execute_once(cmd, echo)
+            if returncode == self.VANISHED_CODE:
+                ui.warn(f'{name} {self.error_code(returncode)}'.strip())
+                returncode = 0
+            if attempt == self.RETRIES:
+                break
+            if returncode == self.SSH_CODE and server:
+                used = Endpoints.used(cmd, server)
+                if not used or cmd not in self._built:
+                    break
+                tried.add(Endpoints.key(used))
+                endpoint = Endpoints.failover(server, used)
+                if not endpoint or Endpoints.key(endpoint) in tried:
+                    break
+                ui.warn(f'{name} {used.server} did not answer, trying {endpoint.server}')
+                # the failed endpoint is last now, so best() picks the new one
+                args, kwargs = self._built[cmd]
+                cmd, _ = self._rsync_cmd(*args, **kwargs)
+                continue
+            if returncode not in self.TRANSIENT_CODES:
+                break
+            delay = self.RETRY_DELAY * 2 ** attempt
+            ui.warn(f'{name} {self.error_code(returncode)} ({returncode}), retrying in {delay}s, '
+                    f'attempt {attempt + 2} of {self.RETRIES + 1}'.strip())
+            time.sleep(delay)
+        return returncode, lines, errors
+
+    def _execute_once(self, cmd, echo=True):
+        """Run a command, passing its output on as it comes
+
+        The --stats block at the end isn't passed on, it goes into the
+        report.  Returns the return code, the output lines and stderr."""
+
+        with tempfile.TemporaryFile() as errors:
+            p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=errors)
+            lines = []
+            stats = False
+            for line in io.TextIOWrapper(p.stdout, encoding='utf-8', errors='replace'):
+                line = line.rstrip('\n')
+                lines.append(line)
+                stats = stats or line.startswith('Number of files:')
+                if echo and line and not stats:
+                    click.echo(line)
+            p.wait()
+            errors.seek(0)
+            return p.returncode, lines, errors.read().decode('utf-8')
+
+    def _verbose_output(self):
+        """Show the commands and rsync's output, json reports replace both"""
+        return not self.silent and self.report != 'json'
+
+    def _show_report(self, report, extra=''):
+        if self.report == 'json':
+            click.echo(json.dumps(report.to_dict(), indent=2))
+        elif not self.silent:
+            extra = f', {extra}' if extra else ''
+            ui.display_success(self.real, f'({report.summary()}{extra})')
+        else:
+            ui.display_success(self.real)
 
     def error_code(self, code):
         code = str(code)
         codes = {
+            '255': 'The ssh connection failed',
             '1': 'Syntax or usage error',
             '2': 'Protocol incompatibility',
             '3': 'Errors selecting input/output files, dirs',
@@ -316,4 +1124,4 @@ class Transfer:
             '30': 'Timeout in data send/receive',
             '35': 'Timeout waiting for daemon connection',
         }
-        return codes[code]
+        return codes.get(code, f'rsync failed with exit code {code}')
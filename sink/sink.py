@@ -1,32 +1,20 @@
 #!/usr/bin/env python3
 import os
-# noinspection PyUnresolvedReferences
-from pprint import pprint as pp
 from pathlib import Path
-import datetime
-from collections import OrderedDict
-import yaml
 from enum import Enum
 import click
 # from rich_click import RichCommand, RichGroup, rich_click
 # import rich_click # as click
 
 
+# Only the modules needed to build the cli are imported here.  Each
+# command imports the modules it uses itself, so `sink single` from an
+# editor doesn't pay for deploy (coolname), vm (plumbum), check (ssl,
+# urllib) etc.  `python -m sink.bench startup` keeps an eye on this.
 from sink.config import config
 from sink.config import Color
 from sink.config import Action
-from sink.check import TestConfig
-from sink.db import DB
-from sink.rsync import Transfer
 from sink.ui import ui
-from sink.ssh import SSH
-from sink.applications import Applications
-from sink.init import Init
-from sink.deploy import DeployViaSymlink
-from sink.deploy import DeployViaRename
-from sink.deploy import DeployViaLocal
-from sink.actions import Actions
-from sink.vm import Vagrant
 
 
 ## RICH_CLICK
@@ -50,13 +38,30 @@ __version__ = '0.2.1'
 
 
 def get_servers(ctx, args, incomplete):
-    config.load_config()
-    servers = [i.name for i in config.servers() if i.name.startswith(incomplete)]
+    index = config.completion_index()
+    servers = [i for i in index.get('servers', []) if i.startswith(incomplete)]
     # if not servers:
     #     ui.error('no servers defined (you are probably not in a project)')
     return servers
 
 
+def get_actions(ctx, args, incomplete):
+    index = config.completion_index()
+    server = ctx.params.get('server')
+    actions = index.get('actions', {}).get(server, [])
+    return [i for i in actions if i.startswith(incomplete)]
+
+
+def parse_streams(streams):
+    """Check a --streams value, a number or 'auto'"""
+    if streams and streams != 'auto':
+        try:
+            streams = int(streams)
+        except ValueError:
+            ui.error(f'--streams must be a number or auto, not {streams}')
+    return streams
+
+
 class NaturalOrderGroup(click.Group):
     """Display commands sorted by order in file
 
@@ -116,6 +121,14 @@ def database(db_action, sql_gz, server, real, quiet, tag):
     pulls_dir/projectname-servername-20-01-01_01-01-01.sql.gz
     """
     config.load_config()
+    if db_action == Action.PULL.value and real:
+        from sink.ssh import Multiplex
+        s = config.server(server)
+        if s.type not in ('lando', 'ddev'):
+            # connect while the db module loads and the file name is worked out
+            Multiplex.prewarm(s)
+
+    from sink.db import DB
     db = DB(real=real, quiet=quiet)
 
     if db_action == Action.PULL.value:
@@ -136,19 +149,48 @@ def database(db_action, sql_gz, server, real, quiet, tag):
               help='Reduced output, for use in Emacs.')
 @click.option('--extra-flags',
               help='extra flags to pass to rsync.')
-def files(action, filename, server, real, silent, extra_flags):
+@click.option('--full', '-f', is_flag=True,
+              help="Have rsync compare every file instead of using sink's manifest.")
+@click.option('--profile', '-p',
+              help="Transfer profile to use instead of the server's.")
+@click.option('--streams', '-n', metavar='N|auto',
+              help='Transfer a dir with N rsyncs at once, auto picks N from past transfers.')
+@click.option('--report', type=click.Choice(['summary', 'json']), default='summary',
+              show_default=True,
+              help='How to show what was transferred, json replaces the normal output.')
+def files(action, filename, server, real, silent, extra_flags, full, profile, streams, report):
     """Send files to and fro.
 
     Push or pull a single file or directory from a remote server.
 
+    When putting a dir, sink sends only the files that changed since
+    the last put to that server.  Files changed on the server by other
+    means won't be noticed, use --full to compare every file.
+
+    How rsync detects changes and compresses is set by the server's
+    transfer profile in sink.yaml, --profile uses a different one.
+    The built in profiles are default (checksums, compressed), lan
+    (size and time, uncompressed) and media (size and time, already
+    compressed files like images sent as they are).
+
+    A large dir can be split into shards that are sent by several
+    rsyncs at once with --streams.  This helps on links where one rsync
+    can't use all the bandwidth or is held up by checksumming.
+
+    After a transfer, a summary of the files created, updated and
+    deleted, the bytes sent and rsync's speedup is shown.  With
+    --report json, it is output as json instead, dry runs included.
+
     \b
     ACTION: pull or put
     SERVER: server name, if not specified sink will use the default server.
     FILENAME: file/dir to be transfered."""
+    from sink.rsync import Transfer
 
     if filename and action == Action.PUT.value and not os.path.exists(filename):
         ui.error(f'Path does not exist: {filename}')
 
+    streams = parse_streams(streams)
     config.load_config()
     if filename:
         f = Path(os.path.abspath(filename))
@@ -156,13 +198,51 @@ def files(action, filename, server, real, silent, extra_flags):
         prj = config.project()
         f = Path(prj.root)
 
-    xfer = Transfer(real, server_name=server, silent=silent)
+    xfer = Transfer(real, server_name=server, silent=silent, profile=profile,
+                    streams=streams, report=report)
     extra_flags = '' if not extra_flags else extra_flags
 
     if action == Action.PULL.value:
         xfer.pull(f, extra_flags)
     elif action == Action.PUT.value:
-        xfer.put(f, extra_flags)
+        xfer.put(f, extra_flags, manifest=True, full=full)
+
+
+@sink.command('media', context_settings=CONTEXT_SETTINGS)
+@click.argument('action', type=click.Choice([Action.PUT.value, Action.PULL.value]))
+@click.argument('server', shell_complete=get_servers)
+@click.option('--real', '-r', is_flag=True)
+@click.option('--silent', '-s', is_flag=True,
+              help='Reduced output.')
+@click.option('--since-last', '-l', is_flag=True,
+              help='Only send files changed since the last media sync with the server.')
+@click.option('--profile', '-p', default='media', show_default=True,
+              help='Transfer profile to use.')
+@click.option('--streams', '-n', metavar='N|auto', default='auto', show_default=True,
+              help='Number of rsyncs to run at once for each dir.')
+def media(action, server, real, silent, since_last, profile, streams):
+    """Sync the upload and other media dirs.
+
+    The dirs are set with 'media' in the project or server section of
+    sink.yaml.  Large trees of images and videos are sent without
+    checksumming every file, by size and time, and without trying to
+    compress files that already are.  Each dir is split between
+    several rsyncs running at once.
+
+    With --since-last, only the files changed since the last media put
+    or pull with the server are sent.  Files deleted or changed without
+    a newer time are not noticed, run without it now and then.
+
+    \b
+    ACTION: pull or put
+    SERVER: server name."""
+    from sink.rsync import Transfer
+
+    streams = parse_streams(streams)
+    config.load_config()
+    xfer = Transfer(real, server_name=server, silent=silent, profile=profile,
+                    streams=streams)
+    xfer.media(Action(action), since_last=since_last)
 
 
 @sink.command('single', context_settings=CONTEXT_SETTINGS)
@@ -176,6 +256,7 @@ def automatic(filename, real, silent):
     Send a single file to any server that has been designated as
     automatic.  This is primarily designed for scripting from a text
     editor."""
+    from sink.rsync import Transfer
 
     config.load_config()
     f = Path(os.path.abspath(filename))
@@ -183,16 +264,47 @@ def automatic(filename, real, silent):
     xfer.single(f)
 
 
+@sink.command('watch', context_settings=CONTEXT_SETTINGS)
+@click.option('--real', '-r', is_flag=True)
+@click.option('--silent', '-s', is_flag=True,
+              help='Reduced output.')
+@click.option('--delete', is_flag=True,
+              help='Delete files on the servers that are deleted locally.')
+@click.option('--delay', default=0.3, show_default=True,
+              help='Seconds to wait for more changes before syncing.')
+def watch(real, silent, delete, delay):
+    """Sync changed files to the automatic servers as they change.
+
+    The project root is watched with inotify, skipping the project's
+    excluded paths.  Changes are collected until there has been no
+    new change for DELAY seconds, then each automatic server gets the
+    whole batch in one rsync."""
+    from sink.watch import Watcher
+
+    config.load_config()
+    watcher = Watcher(real, delay=delay, delete=delete, silent=silent)
+    watcher.watch()
+
+
 @sink.command(context_settings=CONTEXT_SETTINGS)
 @click.argument('server', shell_complete=get_servers)
 @click.argument('user', required=False)
 @click.option('--dry-run', '-d', is_flag=True,
               help='Do nothing, show the command only.')
-def ssh(server, user, dry_run):
-    """SSH into a server."""
+@click.option('--close', '-c', is_flag=True,
+              help="Close the server's shared ssh connections.")
+def ssh(server, user, dry_run, close):
+    """SSH into a server.
+
+    Sink keeps one shared connection open per server and user (see
+    ssh_persist in sink.yaml), --close shuts them down."""
+    from sink.ssh import SSH
     config.load_config()
     ssh = SSH(server=server, user=user, dry_run=dry_run)
-    ssh.visit_ssh()
+    if close:
+        ssh.close()
+    else:
+        ssh.visit_ssh()
 
 
 @sink.command('diff', context_settings=CONTEXT_SETTINGS)
@@ -204,12 +316,31 @@ def ssh(server, user, dry_run):
               help='Use meld instead of "git diff".')
 @click.option('--word-diff', '-w', type=click.Choice(['word', 'letter']),
               help='Refine diffs to word or letter differences.')
-def diff_files(filename, server, ignore_whitespace, word_diff, difftool):
+@click.option('--summary', is_flag=True,
+              help='List the files that differ and by how much, without downloading them.')
+@click.option('--large', '-l', is_flag=True,
+              help='Compare a file in chunks and fetch only the parts that differ.')
+def diff_files(filename, server, ignore_whitespace, word_diff, difftool, summary, large):
     """Diff a local and remote file.
 
+    SERVER can be 'all' or a comma separated list of servers to
+    compare a file on several servers at once.  The servers are
+    grouped by the file's content and each version that differs from
+    the local file is diffed against it.
+
+    For a large dir, --summary lists the files that are only on the
+    server, only local or changed, with the size difference, using an
+    rsync dry run instead of downloading the dir.
+
+    A large file, eg: a log or an sql dump, is split into chunks of
+    lines on both ends and only the chunks that differ are fetched
+    and diffed, this needs python3 on the server.  Files over 64MB are
+    always compared this way, --large does it for any file.
+
     \b
     FILENAME: file to be transferred
-    SERVER: server name (defined in sink.yaml)."""
+    SERVER: server name (defined in sink.yaml), 'all' or eg: dev,prod."""
+    from sink.rsync import Transfer
 
     config.load_config()
 
@@ -217,12 +348,61 @@ def diff_files(filename, server, ignore_whitespace, word_diff, difftool):
         prj = config.project()
         filename = Path(prj.root)
     fx = Path(os.path.abspath(filename))
+
+    if server == 'all' or ',' in server:
+        if server == 'all':
+            servers = [s.name for s in config.servers()
+                       if s.root and (s.ssh or s.transport == 'local')]
+        else:
+            servers = [i.strip() for i in server.split(',') if i.strip()]
+        xfer = Transfer(real=True)
+        xfer.diff_multiple_servers(fx, servers, ignore=ignore_whitespace,
+                                   word_diff=word_diff, difftool=difftool)
+        return
+
     xfer = Transfer(real=True, server_name=server)
+    if summary:
+        xfer.diff_summary(fx)
+        return
     xfer.diff(fx, ignore=ignore_whitespace,
-              word_diff=word_diff, difftool=difftool)
+              word_diff=word_diff, difftool=difftool, large=large)
+
+
+@sink.command('mirror', context_settings=CONTEXT_SETTINGS)
+@click.argument('server', shell_complete=get_servers)
+@click.argument('filename', type=click.Path(exists=True), required=False)
+@click.option('--clear', is_flag=True, help="Delete the server's mirror.")
+def mirror(server, filename, clear):
+    """Update the local mirror of a server.
+
+    sink keeps a copy of each server's files in the project's cache_dir,
+    `sink diff` uses it so only what changed on the server since the
+    last diff is downloaded.  This brings a file or dir (the whole
+    project by default) up to date in the mirror and prints its path,
+    eg: to grep what is on the server:
+
+    \b
+    grep -r TODO "$(sink mirror prod templates | tail -1)"
+
+    \b
+    FILENAME: file or dir to update in the mirror
+    SERVER: server name (defined in sink.yaml)"""
+    from sink.rsync import Transfer
+
+    config.load_config()
+    xfer = Transfer(real=True, server_name=server)
+    if clear:
+        import shutil
+        mirror_dir = xfer.mirror_path()
+        shutil.rmtree(mirror_dir, ignore_errors=True)
+        click.echo(f'Deleted {mirror_dir}')
+        return
+    fx = Path(os.path.abspath(filename)) if filename else None
+    click.echo(xfer.mirror(fx))
 
 
 def edit_config():
+    import yaml
     click.edit(filename=config.config_file)
     try:
         with open(config.config_file) as f:
@@ -278,6 +458,7 @@ def info(view):
 @click.option('--required', '-r', is_flag=True)
 def check(required, server_names):
     """Test server settings in config."""
+    from sink.check import TestConfig
     config.load_config()
     if server_names:
         server_names = [i.lower() for i in server_names]
@@ -291,7 +472,7 @@ def check(required, server_names):
 # ------------------------------- Actions -------------------------------
 @sink.command(context_settings=CONTEXT_SETTINGS)
 @click.argument('server', shell_complete=get_servers)
-@click.argument('action_name', required=False)
+@click.argument('action_name', required=False, shell_complete=get_actions)
 @click.option('--real', '-r', is_flag=True)
 def action(server, action_name, real):
     """Run a pre defined command on the server.
@@ -313,6 +494,7 @@ def action(server, action_name, real):
     If no action is specified, all actions available to that server
     will be listed.
     """
+    from sink.actions import Actions
     config.load_config()
     actions = Actions(server, real)
     if action_name:
@@ -352,6 +534,7 @@ def build(server, hostname, ip):
       - Run `sink db put <sqlfile.sql.gz>`
       - In vagrant vm, remove 000-default.conf & delete /var/www/html
     """
+    from sink.vm import Vagrant
     config.load_config()
     vvm = Vagrant()
     vvm.create(server, ip, hostname)
@@ -368,6 +551,7 @@ def check(server, hostname, ip):
 
     Add an IP and HOSTNAME in /etc/hosts and specify the same here.
     """
+    from sink.vm import Vagrant
     vvm = Vagrant()
     vvm.check(server, ip, hostname)
 
@@ -399,6 +583,7 @@ def init(ctx, server, dirs):
 
     Create a dir localy or on the remote server to hold the versions.
     The exact method depends of the deploy method used."""
+    from sink.deploy import DeployViaRename, DeployViaSymlink, DeployViaLocal
 
     deploytype = DeployType(ctx.obj)
 
@@ -429,10 +614,15 @@ def new(ctx, server, real, quiet, dump_db, note):
     """Upload a new version of the site.
 
     Upload a new version to the deploy root."""
+    from sink.ssh import Multiplex
 
     deploytype = DeployType(ctx.obj)
 
     config.load_config()
+    if real and deploytype != DeployType.LOCAL and config.transport(server) == 'ssh':
+        # connect while the deploy modules load and the build is made
+        Multiplex.prewarm(config.server(server))
+    from sink.deploy import DeployViaRename, DeployViaSymlink, DeployViaLocal
     if deploytype == DeployType.RENAME:
         new_deploy = DeployViaRename(server, real=real)
         new_deploy.new()
@@ -456,6 +646,7 @@ def new(ctx, server, real, quiet, dump_db, note):
 @click.pass_context
 def switch(ctx, server, real, load_db, delete):
     """Change the symlink to point to a different dir in the deploy root."""
+    from sink.deploy import DeployViaRename, DeployViaSymlink, DeployViaLocal
 
     deploytype = DeployType(ctx.obj)
 
@@ -526,6 +717,7 @@ def api(keys, json):
 @misc.command(context_settings=CONTEXT_SETTINGS)
 def pack():
     """Display a command to gzip uncommitted files."""
+    import datetime
     config.load_config()
     now = datetime.datetime.now()
     now = now.strftime('%y-%m-%d-%H-%M-%S')
@@ -549,6 +741,7 @@ def init_config(servers):
     `sink misc init > sink.yaml`
     `sink misc init dev stag prod > sink.yaml`
     """
+    from sink.init import Init
     init_file = Init()
     init_file.servers(servers)
     click.echo(init_file.create())
@@ -562,6 +755,7 @@ def settings(application):
     For the requested application, output settings in a format thats
     easy to copy & paste.
     """
+    from sink.applications import Applications
     config.load_config()
     app = Applications()
     if not app.name(application):
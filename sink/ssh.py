@@ -1,6 +1,12 @@
 import errno
 import os
+import re
+import json
+import time
+import socket
+import threading
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 import click
 from pprint import pprint as pp
 
@@ -8,6 +14,262 @@ from sink.config import config
 from sink.ui import ui
 
 
+class Multiplex:
+    """Share one authenticated ssh connection per server and user
+
+    Every ssh, scp and rsync command sink builds uses these options so
+    only the first one does the tcp/key exchange/auth handshake, the
+    rest reuse the master connection's socket in ~/.cache/sink/ssh.
+
+    The master stays open for ssh_persist after the last command,
+    ssh_persist can be set in the project or server section of
+    sink.yaml.  Set it to 'no' to turn multiplexing off.
+    """
+    DEFAULT_PERSIST = '10m'
+
+    # server name: the thread opening its master connection, see prewarm()
+    _warming = {}
+
+    @staticmethod
+    def socket_dir():
+        sockets = config.cache_home() / 'ssh'
+        sockets.mkdir(mode=0o700, parents=True, exist_ok=True)
+        return sockets
+
+    @staticmethod
+    def control_path():
+        # %C is a hash of the local host, remote host, port and user
+        return Multiplex.socket_dir() / '%C'
+
+    @staticmethod
+    def persist(server):
+        for value in (server.get('ssh_persist'), config.project().get('ssh_persist')):
+            if value is not None:
+                return value
+        return Multiplex.DEFAULT_PERSIST
+
+    @staticmethod
+    def options(server):
+        persist = Multiplex.persist(server)
+        if persist is False:
+            return ''
+        elif persist is True:
+            persist = 'yes'
+        Multiplex._wait(server)
+        return (f'-o ControlMaster=auto -o ControlPath={Multiplex.control_path()} '
+                f'-o ControlPersist={persist}')
+
+    @staticmethod
+    def open(server):
+        """Start the master connection for the server's first ssh user
+
+        Used before several commands are started at once, otherwise
+        they would all race to become the master and most of them
+        would end up with a connection of their own."""
+
+        if Multiplex.persist(server) is False or not server.ssh:
+            return
+        ssh = Endpoints.best(server)
+        port = f'-p {ssh.port}' if ssh.port else ''
+        identity = f'-i {ssh.key}' if ssh.key else ''
+        check = f'ssh {port} -o ControlPath={Multiplex.control_path()} -O check {ssh.username}@{ssh.server}'
+        result = subprocess.run(check, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if result.returncode == 0:
+            return
+        # any error shows up again in the commands that use the connection
+        cmd = f'ssh {port} {identity} {Multiplex.options(server)} -f -N {ssh.username}@{ssh.server}'
+        subprocess.run(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    @staticmethod
+    def prewarm(server):
+        """Open the master connection in the background
+
+        For commands that do local work before their first remote one,
+        eg: a deploy build.  The handshake happens meanwhile and the
+        first command that uses the connection waits for it instead of
+        starting a handshake of its own."""
+
+        if Multiplex.persist(server) is False or not server.ssh:
+            return
+        thread = threading.Thread(target=Multiplex.open, args=(server,), daemon=True)
+        Multiplex._warming[server.name] = thread
+        thread.start()
+
+    @staticmethod
+    def _wait(server):
+        thread = Multiplex._warming.get(server.name)
+        if thread and thread is not threading.current_thread():
+            thread.join()
+            Multiplex._warming.pop(server.name, None)
+
+    @staticmethod
+    def close(server, dry_run=False):
+        """Tell the master connections for each of the server's ssh users to exit"""
+        for ssh in server.ssh:
+            port = f'-p {ssh.port}' if ssh.port else ''
+            cmd = f'ssh {port} -o ControlPath={Multiplex.control_path()} -O exit {ssh.username}@{ssh.server}'
+            cmd = ' '.join(cmd.split())
+            ui.display_cmd(cmd, suppress_commands=config.suppress_commands)
+            if dry_run:
+                continue
+            result = subprocess.run(cmd, shell=True, stderr=subprocess.PIPE)
+            if result.returncode:
+                click.echo(f'No open connection for {ssh.username}@{ssh.server}')
+            else:
+                click.echo(f'Connection closed for {ssh.username}@{ssh.server}')
+
+
+class Endpoints:
+    """Pick the fastest of a server's ssh endpoints
+
+    The ssh entries with the same username as the first one are taken
+    to be other addresses of the same account, eg: a public hostname
+    and a VPN address.  They are probed at once with a tcp connect and
+    the order, fastest working one first, is kept in the project's
+    cache dir for endpoint_ttl (eg: 30s, 10m, 1h, or 'no' to always use
+    the first entry).  An endpoint that fails is moved to the end so
+    the next one is used.
+    """
+    DEFAULT_TTL = '10m'
+    TIMEOUT = 2  # seconds for each probe
+    UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+    _orders = {}
+    # one lock per server, so probing one server doesn't hold up the others
+    _locks = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def _server_lock(server):
+        with Endpoints._lock:
+            return Endpoints._locks.setdefault(server.name, threading.Lock())
+
+    @staticmethod
+    def ttl(server):
+        """endpoint_ttl in seconds, 0 if probing is off"""
+        for value in (server.get('endpoint_ttl'), config.project().get('endpoint_ttl'),
+                      Endpoints.DEFAULT_TTL):
+            if value is not None:
+                break
+        if value is False:
+            return 0
+        if value is True:
+            value = Endpoints.DEFAULT_TTL
+        match = re.fullmatch(r'(\d+)\s*([smhd]?)', str(value).strip())
+        if not match:
+            ui.error(f'Invalid endpoint_ttl for {server.servername}: {value}')
+        return int(match.group(1)) * Endpoints.UNITS[match.group(2) or 's']
+
+    @staticmethod
+    def candidates(server):
+        if not server.ssh:
+            return []
+        first = server.ssh[0]
+        return [i for i in server.ssh if i.username == first.username]
+
+    @staticmethod
+    def key(ssh):
+        return f'{ssh.username}@{ssh.server}:{ssh.port or 22}'
+
+    @staticmethod
+    def order(server):
+        """The server's endpoints, the one to use first"""
+        candidates = Endpoints.candidates(server)
+        if len(candidates) < 2:
+            return candidates
+        ttl = Endpoints.ttl(server)
+        with Endpoints._server_lock(server):
+            order = Endpoints._orders.get(server.name)
+            if order is None and ttl:
+                order = Endpoints._load(server, ttl)
+                if order is None:
+                    order = Endpoints.probe(candidates)
+                    Endpoints._save(server, order)
+                Endpoints._orders[server.name] = order
+        if order is None:
+            return candidates
+        keys = {Endpoints.key(i): i for i in candidates}
+        ordered = [keys.pop(i) for i in order if i in keys]
+        # entries added to sink.yaml since the probe go last
+        return ordered + list(keys.values())
+
+    @staticmethod
+    def best(server):
+        """The endpoint to use for the server, the first ssh entry if there is one"""
+        order = Endpoints.order(server)
+        return order[0] if order else server.ssh[0]
+
+    @staticmethod
+    def probe(candidates):
+        """Return the endpoint keys, the fastest to connect to first
+
+        The ones that can't be reached keep their order from sink.yaml
+        at the end, eg: a host that is only reachable through a jump
+        host set up in ~/.ssh/config."""
+
+        def connect(ssh):
+            start = time.monotonic()
+            try:
+                with socket.create_connection((ssh.server, ssh.port or 22), Endpoints.TIMEOUT):
+                    return time.monotonic() - start
+            except OSError:
+                return None
+
+        with ThreadPoolExecutor(max_workers=len(candidates)) as pool:
+            latencies = list(pool.map(connect, candidates))
+        reachable = sorted([(latency, i) for i, latency in enumerate(latencies)
+                            if latency is not None])
+        first = [i for latency, i in reachable]
+        rest = [i for i in range(len(candidates)) if i not in first]
+        return [Endpoints.key(candidates[i]) for i in first + rest]
+
+    @staticmethod
+    def failover(server, failed):
+        """Move a failed endpoint to the end, returns the next one or None"""
+        candidates = Endpoints.candidates(server)
+        if len(candidates) < 2:
+            return None
+        order = [Endpoints.key(i) for i in Endpoints.order(server)]
+        with Endpoints._server_lock(server):
+            order = list(Endpoints._orders.get(server.name) or order)
+            failed = Endpoints.key(failed)
+            # another command may have moved it already
+            if order[0] == failed:
+                order = order[1:] + [failed]
+                Endpoints._orders[server.name] = order
+                if Endpoints.ttl(server):
+                    Endpoints._save(server, order)
+        return Endpoints.order(server)[0]
+
+    @staticmethod
+    def used(cmd, server):
+        """The endpoint of the server a command was built for"""
+        for ssh in Endpoints.candidates(server):
+            if re.search(rf'{re.escape(ssh.username)}@{re.escape(ssh.server)}(?![\w.-])', cmd):
+                return ssh
+        return None
+
+    @staticmethod
+    def _file(server):
+        return config.project_cache('endpoints') / f'{server.name}.json'
+
+    @staticmethod
+    def _load(server, ttl):
+        try:
+            with open(Endpoints._file(server)) as f:
+                saved = json.load(f)
+            if time.time() - saved['checked'] < ttl:
+                return saved['order']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return None
+
+    @staticmethod
+    def _save(server, order):
+        content = json.dumps({'checked': time.time(), 'order': order})
+        config._write_cache_file(Endpoints._file(server), content.encode('utf-8'))
+
+
 class SSH:
     def __init__(self, server=False, user=None, dry_run=False):
         self.dry_run = dry_run
@@ -21,7 +283,10 @@ class SSH:
             else:
                 ui.error(f'Invalid ssh user: {user}')
         else:
-            self.ssh = self.server.ssh[0]
+            self.ssh = Endpoints.best(self.server)
+
+    def close(self):
+        Multiplex.close(self.server, dry_run=self.dry_run)
 
     def visit_ssh(self):
         identity = self.get_key()
@@ -33,7 +298,8 @@ class SSH:
         if self.server.root:
             cd_cmd = f'"cd {self.server.root}; bash"'
 
-        cmd = f'''ssh -t {port} {identity} {self.ssh.username}@{self.ssh.server} {cd_cmd}'''
+        mux = Multiplex.options(self.server)
+        cmd = f'''ssh -t {port} {identity} {mux} {self.ssh.username}@{self.ssh.server} {cd_cmd}'''
         cmd = ' '.join(cmd.split())
 
         self.run_cmd(cmd, self.dry_run)
@@ -47,7 +313,8 @@ class SSH:
         if self.ssh.port:
             port = f'-P {self.ssh.port}'
 
-        cmd = f'''scp {port} -o 'ConnectTimeout 10' {identity}
+        mux = Multiplex.options(self.server)
+        cmd = f'''scp {port} -o 'ConnectTimeout 10' {identity} {mux}
             {localfile} {self.ssh.username}@{self.ssh.server}'''
         cmd = ' '.join(cmd.split())
 
@@ -59,7 +326,8 @@ class SSH:
         if self.ssh.port:
             port = f'-P {self.ssh.port}'
 
-        cmd = f'''scp {port} -o 'ConnectTimeout 10' {identity}
+        mux = Multiplex.options(self.server)
+        cmd = f'''scp {port} -o 'ConnectTimeout 10' {identity} {mux}
             {self.ssh.username}@{self.ssh.server}:{remotefile} {dest}'''
         cmd = ' '.join(cmd.split())
         self.run_cmd(cmd, self.dry_run)
@@ -71,7 +339,8 @@ class SSH:
         if self.ssh.port:
             port = f'-p {self.ssh.port}'
 
-        cmd = f'''ssh {port} {identity} {self.ssh.username}@{self.ssh.server} {remote_cmd}'''
+        mux = Multiplex.options(self.server)
+        cmd = f'''ssh {port} {identity} {mux} {self.ssh.username}@{self.ssh.server} {remote_cmd}'''
         cmd = ' '.join(cmd.split())
 
         result = self.run_cmd_result(cmd, self.dry_run)
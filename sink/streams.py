@@ -0,0 +1,78 @@
+import json
+import heapq
+from pathlib import Path
+
+from sink.config import config
+
+
+# A file costs rsync a round of metadata no matter how small it is, so
+# each file weighs this much on top of its size when sharding.
+PER_FILE_BYTES = 64 * 1024
+
+
+def shard(files, count):
+    """Split [(path, size)] into at most count lists of about equal weight
+
+    The heaviest files are placed first, each in the lightest shard so
+    far, so one shard doesn't end up with all the big files or all the
+    small ones."""
+
+    count = max(1, min(count, len(files)))
+    shards = [[] for _ in range(count)]
+    heap = [(0, i) for i in range(count)]
+    for path, size in sorted(files, key=lambda f: f[1], reverse=True):
+        weight, i = heapq.heappop(heap)
+        shards[i].append(path)
+        heapq.heappush(heap, (weight + size + PER_FILE_BYTES, i))
+    return [sorted(i) for i in shards if i]
+
+
+class StreamTuner:
+    """Pick the number of rsync streams for a server from past transfers
+
+    The throughput of each stream count used is kept in the project's
+    cache dir.  The count is doubled while doing so has made transfers
+    faster, then the fastest one seen is used."""
+
+    START = 2
+    MAX = 8
+    # transfers smaller than this say more about latency than throughput
+    MIN_BYTES = 8 * 1024 * 1024
+
+    def __init__(self, server_name):
+        self.file = config.project_cache('streams') / f'{server_name}.json'
+        try:
+            with open(self.file) as f:
+                self.rates = {int(k): v for k, v in json.load(f).items()}
+        except (OSError, ValueError):
+            self.rates = {}
+
+    def choose(self):
+        if not self.rates:
+            return self.START
+        best = max(self.rates, key=self.rates.get)
+        if best == max(self.rates) and best * 2 <= self.MAX:
+            return best * 2
+        return best
+
+    def record(self, count, size, seconds):
+        """Save the bytes per second of a transfer with count streams"""
+        if size < self.MIN_BYTES or seconds <= 0:
+            return
+        rate = size / seconds
+        old = self.rates.get(count)
+        # smooth it out, one slow transfer shouldn't undo the others
+        self.rates[count] = rate if old is None else (old + rate) / 2
+        content = json.dumps({str(k): v for k, v in sorted(self.rates.items())})
+        config._write_cache_file(self.file, content.encode('utf-8'))
+
+
+def write_shards(shards, directory):
+    """Write each shard to a file in directory for rsync's --files-from"""
+    files = []
+    for i, paths in enumerate(shards):
+        path = Path(directory, f'{i}.files')
+        with open(path, 'w') as f:
+            f.write(''.join([f'{p}\n' for p in paths]))
+        files.append(path)
+    return files
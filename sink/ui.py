@@ -1,7 +1,6 @@
 import sys
 import os
 import click
-from pprint import pprint as pp
 from enum import Enum
 from textwrap import TextWrapper
 
@@ -0,0 +1,181 @@
+import os
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import click
+
+from sink.config import config
+from sink.config import Action
+from sink.ui import ui
+from sink.rsync import Transfer
+
+
+# from /usr/include/linux/inotify.h
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EVENT = struct.Struct('iIII')
+
+
+class Inotify:
+    """Minimal recursive inotify watcher using libc through ctypes"""
+
+    def __init__(self, root, excluded=None):
+        self.root = Path(root)
+        self.excluded = excluded or (lambda relpath: False)
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            ui.error(f'inotify is not available: {os.strerror(errno)}')
+        self.watches = {}
+
+    def add_tree(self, top):
+        """Watch top and every dir below it that isn't excluded"""
+        for dirpath, dirnames, filenames in os.walk(top):
+            relpath = os.path.relpath(dirpath, self.root)
+            if relpath != '.' and self.excluded(relpath):
+                dirnames[:] = []
+                continue
+            # prune excluded dirs before os.walk descends into them
+            dirnames[:] = [d for d in dirnames
+                           if not self.excluded(os.path.normpath(os.path.join(relpath, d)))]
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath), WATCH_MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                ui.warn(f'Cannot watch {dirpath}: {os.strerror(errno)}')
+                continue
+            self.watches[wd] = dirpath
+
+    def read(self, timeout):
+        """Return the relative paths that changed, None if the queue overflowed"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        changed = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            dirpath = self.watches.get(wd)
+            if dirpath is None:
+                continue
+            path = os.path.join(dirpath, os.fsdecode(name)) if name else dirpath
+            relpath = os.path.relpath(path, self.root)
+            if relpath == '.' or self.excluded(relpath):
+                continue
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # new dirs need their own watches
+                self.add_tree(path)
+            changed.append(relpath)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher:
+    # most servers synced at the same time
+    WORKERS = 8
+
+    def __init__(self, real, delay=0.3, max_delay=3, delete=False, silent=False):
+        """Watch the project root and sync changes to the automatic servers
+
+        delay: seconds without changes before a batch is sent
+        max_delay: longest a batch will wait during a constant stream of changes
+        delete: delete files on the servers that were deleted locally
+        """
+        self.real = real
+        self.delay = delay
+        self.max_delay = max_delay
+        self.delete = delete
+        self.silent = silent
+        self.root = Path(config.project().root)
+        self.servers = [s for s in config.servers() if s.automatic]
+        if not self.servers:
+            ui.error('No servers are set to automatic in sink.yaml')
+        self.excluded = config.exclude_matcher()
+
+    def watch(self):
+        inotify = Inotify(self.root, excluded=self.excluded)
+        inotify.add_tree(self.root)
+        names = ', '.join([s.servername for s in self.servers])
+        ui.notice(f'Watching {self.root} ({len(inotify.watches)} dirs) for {names}, ctrl-c to stop.')
+
+        batch = set()
+        first = None
+        try:
+            while True:
+                changed = inotify.read(self.delay if batch else None)
+                if changed is None:
+                    # too many events were missed, send the whole tree
+                    ui.warn('inotify queue overflowed, syncing everything')
+                    batch = {'.'}
+                    first = first or time.monotonic()
+                elif changed:
+                    batch.update(changed)
+                    first = first or time.monotonic()
+                    if time.monotonic() - first < self.max_delay:
+                        continue
+                if batch:
+                    self.sync(sorted(batch))
+                    batch = set()
+                    first = None
+        except KeyboardInterrupt:
+            click.echo()
+        finally:
+            inotify.close()
+
+    def sync(self, paths):
+        """Send one batch of paths to every automatic server
+
+        Each server gets one rsync that reads the paths with
+        --files-from, over the server's shared ssh connection."""
+
+        files = ''.join([f'{i}\n' for i in paths]).encode('utf-8')
+        missing = '--delete-missing-args' if self.delete else '--ignore-missing-args'
+        flags = f'--files-from=- {missing}'
+
+        xfer = Transfer(self.real, silent=self.silent)
+        xfer.multiple = True
+        jobs = []
+        with ThreadPoolExecutor(max_workers=min(len(self.servers), self.WORKERS)) as pool:
+            for server in self.servers:
+                cmd, s = xfer._rsync_cmd(f'{self.root}/', server.root, Action.PUT,
+                                         extra_flags=flags, server=server.name)
+                job = pool.submit(subprocess.run, cmd, shell=True, input=files,
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                jobs.append((cmd, server, job))
+
+        summary = paths[0] if len(paths) == 1 else f'{len(paths)} paths'
+        for cmd, server, job in jobs:
+            result = job.result()
+            if not self.silent:
+                ui.display_cmd(cmd, suppress_commands=config.suppress_commands)
+                click.echo(result.stdout.decode('utf-8'), nl=False)
+            if result.returncode:
+                ui.error(f'[{server.servername}]\n{result.stderr.decode("utf-8")}', exit=False)
+            else:
+                ui.display_success(self.real, f'[{server.servername}] {summary}')